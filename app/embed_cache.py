@@ -0,0 +1,98 @@
+# app/embed_cache.py
+from __future__ import annotations
+
+from typing import Callable, Dict, Sequence, Tuple
+import os
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+
+# SQLite builds before 3.32 cap bound parameters at 999 per statement
+_MAX_PARAMS = 500
+
+
+def content_key(model: str, text: str) -> bytes:
+    """Cache key for a (model, text) pair; 16-byte BLAKE2b digest."""
+    return hashlib.blake2b(f"{model}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+
+def quantize(vec: np.ndarray) -> Tuple[float, bytes]:
+    """Symmetric int8 quantization with one scale per vector."""
+    v = np.asarray(vec, dtype=np.float32)
+    peak = float(np.abs(v).max()) if v.size else 0.0
+    scale = peak / 127.0 if peak > 0 else 1.0
+    return scale, np.round(v / scale).astype(np.int8).tobytes()
+
+
+def dequantize(scale: float, data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.int8).astype(np.float32) * np.float32(scale)
+
+
+def _encode_plain(dtype: type) -> Callable[[np.ndarray], Tuple[float, bytes]]:
+    return lambda vec: (1.0, np.asarray(vec, dtype=dtype).tobytes())
+
+
+def _decode_plain(dtype: type) -> Callable[[float, bytes], np.ndarray]:
+    return lambda scale, data: np.frombuffer(data, dtype=dtype).astype(np.float32)
+
+
+# dtype -> (table, encode, decode); each dtype has its own table, so
+# switching EMBED_CACHE_DTYPE never mixes encodings
+_CODECS: Dict[str, Tuple[str, Callable[[np.ndarray], Tuple[float, bytes]],
+                         Callable[[float, bytes], np.ndarray]]] = {
+    "int8": ("embeddings_i8", quantize, dequantize),
+    "float16": ("embeddings_f16", _encode_plain(np.float16), _decode_plain(np.float16)),
+    "float32": ("embeddings_f32", _encode_plain(np.float32), _decode_plain(np.float32)),
+}
+
+
+class EmbedCache:
+    """Content-addressed on-disk store of embedding vectors.
+    By default vectors are int8-quantized (1 byte per dim plus a scale), a
+    quarter of float32; the rounding error is far below what changes
+    retrieval order. `dtype` may also be "float16" or "float32"."""
+
+    def __init__(self, path: str, dtype: str = "int8"):
+        if dtype not in _CODECS:
+            raise ValueError(f"Unsupported embedding cache dtype: {dtype!r}")
+        self._table, self._encode, self._decode = _CODECS[dtype]
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                "hash BLOB PRIMARY KEY, scale REAL NOT NULL, vec BLOB NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return {key: float32 vector} for every key present in the cache."""
+        found: Dict[bytes, np.ndarray] = {}
+        uniq = list(dict.fromkeys(keys))
+        with self._lock:
+            for s in range(0, len(uniq), _MAX_PARAMS):
+                batch = uniq[s:s + _MAX_PARAMS]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, scale, vec FROM {self._table} WHERE hash IN ({marks})", batch
+                ).fetchall()
+                for h, scale, vec in rows:
+                    found[h] = self._decode(scale, vec)
+        return found
+
+    def put_many(self, items: Sequence[Tuple[bytes, np.ndarray]]) -> None:
+        """Store vectors; keys already present are left untouched."""
+        rows = [(h, *self._encode(v)) for h, v in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO {self._table} (hash, scale, vec) VALUES (?, ?, ?)", rows
+            )
+            self._conn.commit()
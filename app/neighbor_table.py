@@ -0,0 +1,56 @@
+# app/neighbor_table.py
+from __future__ import annotations
+
+from typing import List, Optional, Tuple
+import os
+import hashlib
+import sqlite3
+import threading
+
+import orjson
+
+
+def query_key(query: str) -> bytes:
+    """Key for a query, insensitive to case and whitespace differences."""
+    normalized = " ".join(query.lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+class NeighborTable:
+    """Precomputed results for hot queries: query hash -> (k, [(id, distance)])."""
+
+    def __init__(self, path: str):
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS neighbors ("
+                "hash BLOB PRIMARY KEY, k INTEGER NOT NULL, hits TEXT NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, query: str) -> Optional[Tuple[int, List[Tuple[str, float]]]]:
+        """Return (k the hits were computed for, hits), or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT k, hits FROM neighbors WHERE hash = ?", (query_key(query),)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], [(i, d) for i, d in orjson.loads(row[1])]
+
+    def put(self, query: str, k: int, hits: List[Tuple[str, float]]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO neighbors (hash, k, hits) VALUES (?, ?, ?)",
+                (query_key(query), k, orjson.dumps(hits).decode()),
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM neighbors")
+            self._conn.commit()
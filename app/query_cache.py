@@ -0,0 +1,73 @@
+# app/query_cache.py
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional
+import threading
+
+import numpy as np
+
+
+class QueryCache:
+    """In-memory semantic cache: query embedding -> search hits.
+    A query whose embedding has cosine similarity >= `min_sim` to a cached
+    one reuses that query's hits. Lookup is one matrix-vector product over
+    at most `capacity` rows; the least recently used entry is evicted."""
+
+    def __init__(self, capacity: int = 256, min_sim: float = 0.95):
+        self.capacity = max(1, capacity)
+        self.min_sim = min_sim
+        self._lock = threading.Lock()
+        self._keys: Optional[np.ndarray] = None  # (capacity, dim) unit vectors
+        self._ks: List[int] = []
+        self._hits: List[List[Dict[str, Any]]] = []
+        self._used = np.zeros(self.capacity, dtype=np.int64)
+        self._tick = 0
+
+    @staticmethod
+    def _unit(emb: np.ndarray) -> np.ndarray:
+        q = np.asarray(emb, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(q))
+        return q / norm if norm > 0 else q
+
+    def __len__(self) -> int:
+        return len(self._hits)
+
+    def get(self, emb: np.ndarray, k: int) -> Optional[List[Dict[str, Any]]]:
+        """Top-k hits of the most similar cached query, or None."""
+        q = self._unit(emb)
+        with self._lock:
+            n = len(self._hits)
+            if n == 0 or self._keys is None or self._keys.shape[1] != q.shape[0]:
+                return None
+            sims = self._keys[:n] @ q
+            best = int(np.argmax(sims))
+            if sims[best] < self.min_sim or self._ks[best] < k:
+                return None
+            self._tick += 1
+            self._used[best] = self._tick
+            return list(self._hits[best][:k])
+
+    def put(self, emb: np.ndarray, k: int, hits: List[Dict[str, Any]]) -> None:
+        q = self._unit(emb)
+        with self._lock:
+            if self._keys is None or self._keys.shape[1] != q.shape[0]:
+                self._keys = np.zeros((self.capacity, q.shape[0]), dtype=np.float32)
+                self._ks, self._hits = [], []
+            n = len(self._hits)
+            if n < self.capacity:
+                slot = n
+                self._ks.append(k)
+                self._hits.append(list(hits))
+            else:
+                slot = int(np.argmin(self._used))
+                self._ks[slot] = k
+                self._hits[slot] = list(hits)
+            self._keys[slot] = q
+            self._tick += 1
+            self._used[slot] = self._tick
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys = None
+            self._ks, self._hits = [], []
+            self._used[:] = 0
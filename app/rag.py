@@ -1,52 +1,138 @@
 # app/rag.py
 from __future__ import annotations
 
-from typing import List, Dict, Any
+from typing import TYPE_CHECKING, BinaryIO, Callable, Mapping, cast, List, Dict, Any, Optional, Iterable, Iterator, Sequence, Tuple, Union
 import os
+import io
+import csv
+import contextlib
 import json
-import re
 import shutil
+import threading
 import datetime
+import difflib
+import functools
+import itertools
 import mimetypes
+import mmap
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import chromadb
+from chromadb import Collection
+from chromadb.api import ClientAPI
+from chromadb.api.types import IncludeEnum, Metadatas
 from chromadb.config import Settings
 import ollama
-import frontmatter  # Markdown + YAML front-matter
+import httpx
+import frontmatter  # type: ignore[import-untyped]  # Markdown + YAML front-matter
 from pypdf import PdfReader
-import docx2txt
-import pandas as pd
+import docx2txt  # type: ignore[import-untyped]
+import orjson
+import pandas as pd  # type: ignore[import-untyped]
+from openpyxl import load_workbook  # type: ignore[import-untyped]
+import numpy as np
+
+try:  # optional: Rust spreadsheet reader, ~10x faster than openpyxl
+    from python_calamine import CalamineWorkbook  # type: ignore[import-not-found]
+except ImportError:  # pragma: no cover - depends on the environment
+    CalamineWorkbook = None
+
+from app.embed_cache import EmbedCache, content_key
+from app.neighbor_table import NeighborTable
+from app.query_cache import QueryCache
+from app.matrix_index import MatrixIndex
+from app.vector_index import VectorIndex
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer  # type: ignore[import-not-found]
+    from tokenizers import Tokenizer  # type: ignore[import-untyped]
 
 
 # -----------------------
 # Config
 # -----------------------
 CHROMA_PATH = os.getenv("CHROMA_PATH", "chroma")
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "documents")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 GEN_MODEL = os.getenv("GEN_MODEL", "llama3:8b")
+GEN_KEEP_ALIVE = os.getenv("GEN_KEEP_ALIVE", "30m")
+# Context window requested from Ollama for generation
+GEN_NUM_CTX = int(os.getenv("GEN_NUM_CTX", "4096"))
+# Token budget for retrieved context; leaves headroom under GEN_NUM_CTX
+MAX_CTX_TOKENS = int(os.getenv("MAX_CTX_TOKENS", "2048"))
+CONTEXT_DEDUP_RATIO = 0.7  # drop a hit this similar to an already-kept one
+APPLY_CACHE_NAME = os.getenv("APPLY_CACHE_NAME", "apply_cache")
+# Max cosine distance for reusing a stored draft; 0 disables the response cache
+APPLY_CACHE_MAX_DISTANCE = float(os.getenv("APPLY_CACHE_MAX_DISTANCE", "0.08"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# "ollama" (default) or "st": embed in-process with sentence-transformers,
+# skipping the HTTP hop. Vectors differ between backends; re-ingest on switch.
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "ollama").strip().lower()
+ST_EMBED_MODEL = os.getenv("ST_EMBED_MODEL", "nomic-ai/nomic-embed-text-v1")
+ST_DEVICE = os.getenv("ST_DEVICE") or None  # None lets torch pick cuda/mps/cpu
+# Max embedding requests in flight to Ollama across all callers
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "2"))
+# Chunks embedded + upserted to Chroma per round
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "64"))
+# Chunks a BatchBuffer collects (across files) before one Chroma write
+BULK_FLUSH_CHUNKS = int(os.getenv("BULK_FLUSH_CHUNKS", "200"))
+# Token-aware chunking: CHUNK_TOKENS > 0 splits on tokenizer offsets instead
+# of characters. CHUNK_TOKENIZER is a tokenizer.json path or HF Hub model id.
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "0"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", str(CHUNK_TOKENS // 6)))
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "nomic-ai/nomic-embed-text-v1")
+# Set EMBED_CACHE_PATH="" to disable the on-disk embedding cache
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join(CHROMA_PATH, "embcache.sqlite3"))
+# Storage precision of cached vectors: int8 (default), float16 or float32
+EMBED_CACHE_DTYPE = os.getenv("EMBED_CACHE_DTYPE", "int8")
+NEIGHBOR_TABLE_PATH = os.getenv("NEIGHBOR_TABLE_PATH", os.path.join(CHROMA_PATH, "neighbors.sqlite3"))
+# Rewritten with a fresh token on every corpus change, by every process
+CORPUS_STAMP_PATH = os.getenv("CORPUS_STAMP_PATH", os.path.join(CHROMA_PATH, "corpus.stamp"))
+# Near-duplicate queries (cosine >= QUERY_CACHE_MIN_SIM) reuse earlier hits;
+# QUERY_CACHE_SIZE=0 disables the in-memory query cache
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_MIN_SIM = float(os.getenv("QUERY_CACHE_MIN_SIM", "0.95"))
+# Corpora up to this many chunks are searched exactly with an in-memory
+# matrix instead of Chroma's HNSW; 0 always uses Chroma
+MATRIX_SEARCH_MAX_N = int(os.getenv("MATRIX_SEARCH_MAX_N", "100000"))
+# Larger corpora: search an in-process hnswlib index fed by our own writes
+# (LOCAL_HNSW=0 sends them to Chroma's HNSW instead)
+LOCAL_HNSW = os.getenv("LOCAL_HNSW", "1") != "0"
 
-_client = None
-_collection = None
+_init_lock = threading.Lock()
+_embed_cache: Optional[EmbedCache] = None
+_embed_cache_lock = threading.Lock()
+_neighbor_table: Optional[NeighborTable] = None
+_neighbor_table_lock = threading.Lock()
+_query_cache: Optional[QueryCache] = (
+    QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_MIN_SIM) if QUERY_CACHE_SIZE > 0 else None
+)
+# At most one of these is set, depending on the corpus size
+_matrix_index: Optional[MatrixIndex] = None
+_vector_index: Optional[VectorIndex] = None
+_local_count = -1  # collection size the local index reflects; -1 = stale
+_local_stamp = ""  # corpus stamp it reflects
+_local_lock = threading.Lock()
+_INDEX_PAGE = 5000  # chunks per collection.get() while building _vector_index
 
 
 # -----------------------
 # Chroma init (resilient)
 # -----------------------
-def _init_chroma(reset_if_broken: bool = True):
-    """Lazy-init Chroma and collection; auto-reset if local store is broken."""
-    global _client, _collection
-    if _client is not None and _collection is not None:
-        return _client, _collection
-
+@functools.cache
+def _open_chroma(reset_if_broken: bool = True) -> Tuple[ClientAPI, Collection]:
+    """Open Chroma and collection once; auto-reset if local store is broken."""
     try:
-        _client = chromadb.PersistentClient(
+        client = chromadb.PersistentClient(
             path=CHROMA_PATH,
             settings=Settings(allow_reset=True)
         )
-        _collection = _client.get_or_create_collection(name=COLLECTION_NAME)
-        return _client, _collection
+        return client, client.get_or_create_collection(name=COLLECTION_NAME)
     except Exception:
         if not reset_if_broken:
             raise
@@ -55,33 +141,161 @@ def _init_chroma(reset_if_broken: bool = True):
             shutil.rmtree(CHROMA_PATH, ignore_errors=True)
         except Exception:
             pass
-        _client = chromadb.PersistentClient(
+        client = chromadb.PersistentClient(
             path=CHROMA_PATH,
             settings=Settings(allow_reset=True)
         )
-        _collection = _client.get_or_create_collection(name=COLLECTION_NAME)
-        return _client, _collection
+        return client, client.get_or_create_collection(name=COLLECTION_NAME)
+
+
+def _init_chroma(reset_if_broken: bool = True) -> Tuple[ClientAPI, Collection]:
+    """Lazy-init Chroma and collection. The lock makes first use from
+    concurrent request threads open (or reset) the store exactly once."""
+    with _init_lock:
+        return _open_chroma(reset_if_broken)
+
+
+# -----------------------
+# Ollama client
+# -----------------------
+# One pool per client for the whole process. httpx drops idle connections
+# after 5s by default, shorter than the gap between ingest batches while a
+# file is parsed or written to Chroma; keep them for 30s instead.
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=16, keepalive_expiry=30)
+_ollama = ollama.Client(host=OLLAMA_HOST, timeout=OLLAMA_TIMEOUT, limits=_HTTP_LIMITS)
+# Direct client for /api/embed, which the pinned SDK does not wrap yet
+_http = httpx.Client(
+    base_url=OLLAMA_HOST if "://" in OLLAMA_HOST else f"http://{OLLAMA_HOST}",
+    timeout=OLLAMA_TIMEOUT,
+    limits=_HTTP_LIMITS,
+)
 
 
 # -----------------------
 # Embeddings
 # -----------------------
-def embed_texts(texts: List[str]) -> List[List[float]]:
-    """Create embeddings locally via Ollama."""
-    out: List[List[float]] = []
-    for t in texts:
-        resp = ollama.embeddings(model=EMBED_MODEL, prompt=t)
-        emb = resp.get("embedding")
-        if not isinstance(emb, list):
-            raise RuntimeError(f"Embedding failed for text chunk (len={len(t)}).")
-        out.append(emb)
+# Used only for Ollama servers without /api/embed (< 0.3.4); threads are
+# created lazily on first use.
+_embed_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="embed")
+_embed_slots = threading.BoundedSemaphore(max(1, OLLAMA_NUM_PARALLEL))
+_batch_endpoint = True  # flipped off once the server turns out to lack /api/embed
+
+
+def _embed_one(text: str) -> List[float]:
+    resp = _ollama.embeddings(model=EMBED_MODEL, prompt=text)
+    emb = resp.get("embedding")
+    if not isinstance(emb, list):
+        raise RuntimeError(f"Embedding failed for text chunk (len={len(text)}).")
+    return emb
+
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed one batch in a single /api/embed request, or one request per
+    text on old servers."""
+    with _embed_slots:
+        return _embed_batch_unbounded(texts)
+
+
+def _embed_batch_unbounded(texts: List[str]) -> List[List[float]]:
+    global _batch_endpoint
+    if _batch_endpoint:
+        resp = _http.post("/api/embed", json={"model": EMBED_MODEL, "input": texts})
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+        embs = data.get("embeddings") if isinstance(data, dict) else None
+        if resp.status_code == 200 and isinstance(embs, list) and len(embs) == len(texts):
+            return embs
+        if resp.status_code == 404 and "error" not in data:
+            _batch_endpoint = False  # plain router 404: endpoint missing
+        else:
+            raise RuntimeError(
+                f"Embedding failed for batch of {len(texts)} chunks: "
+                f"{data.get('error') or resp.status_code}"
+            )
+    return list(_embed_pool.map(_embed_one, texts))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_st_model() -> SentenceTransformer:
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise RuntimeError(
+            "EMBED_BACKEND=st requires sentence-transformers "
+            "(pip install sentence-transformers)."
+        ) from e
+    # nomic-embed-text ships its own modelling code
+    return SentenceTransformer(ST_EMBED_MODEL, device=ST_DEVICE, trust_remote_code=True)
+
+
+def _cache_model_id() -> str:
+    """Model part of the embedding cache key, distinct per backend."""
+    return f"st:{ST_EMBED_MODEL}" if EMBED_BACKEND == "st" else EMBED_MODEL
+
+
+def _get_embed_cache() -> Optional[EmbedCache]:
+    """Lazy-open the embedding cache; None when disabled."""
+    global _embed_cache
+    if _embed_cache is None and EMBED_CACHE_PATH:
+        with _embed_cache_lock:
+            if _embed_cache is None:
+                _embed_cache = EmbedCache(EMBED_CACHE_PATH, EMBED_CACHE_DTYPE)
+    return _embed_cache
+
+
+def _embed_uncached(texts: List[str], batch_size: int) -> np.ndarray:
+    step = max(1, batch_size)
+    if EMBED_BACKEND == "st":
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        out = _get_st_model().encode(
+            texts, batch_size=step, convert_to_numpy=True, normalize_embeddings=True
+        )
+        return np.asarray(out, dtype=np.float32)
+    batches = [
+        np.asarray(_embed_batch(texts[s:s + step]), dtype=np.float32)
+        for s in range(0, len(texts), step)
+    ]
+    if not batches:
+        return np.empty((0, 0), dtype=np.float32)
+    out = batches[0] if len(batches) == 1 else np.vstack(batches)
+    # /api/embed returns unit vectors, /api/embeddings does not; normalize so
+    # both paths (and everything already cached) live on the same scale
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
     return out
 
 
+def embed_texts(texts: List[str], batch_size: int = EMBED_BATCH_SIZE) -> np.ndarray:
+    """Create embeddings locally via Ollama (or sentence-transformers with
+    EMBED_BACKEND=st), `batch_size` texts per request.
+    Returns a float32 array of shape (len(texts), dim); vectors already in
+    the content-hash cache are not recomputed, and a text repeated within
+    one call is sent only once."""
+    if not texts:
+        return _embed_uncached(texts, batch_size)
+
+    cache = _get_embed_cache()
+    model_id = _cache_model_id()
+    keys = [content_key(model_id, t) for t in texts]
+    found = cache.get_many(keys) if cache is not None else {}
+    # dict keeps first-seen order, so misses go out in input order
+    todo = {k: t for k, t in zip(keys, texts) if k not in found}
+    if todo:
+        fresh = _embed_uncached(list(todo.values()), batch_size)
+        new_items = list(zip(todo, fresh))
+        if cache is not None:
+            cache.put_many(new_items)
+        found.update(new_items)
+    return np.stack([found[k] for k in keys])
+
+
 # -----------------------
 # Helpers
 # -----------------------
-def _validate_file_path(filepath: str) -> Path:
+def _validate_file_path(filepath: Union[str, os.PathLike]) -> Path:
     """Validate and resolve file path to prevent directory traversal attacks.
     Returns a resolved Path object if valid, raises FileNotFoundError/ValueError."""
     try:
@@ -99,17 +313,81 @@ def _validate_file_path(filepath: str) -> Path:
         raise ValueError(f"Invalid file path: {filepath} - {e}")
 
 
+def _chunk_iter(text: str, chunk: int = 900, overlap: int = 150) -> Iterator[str]:
+    """Yield overlapping character windows lazily, so ingestion holds one
+    batch of chunks rather than all of them."""
+    step = max(1, chunk - overlap)
+    # Windows starting in trailing whitespace would be blank; stop before them
+    end = len(text.rstrip())
+    for i in range(0, end, step):
+        yield text[i:i + chunk]
+
+
 def _chunk(text: str, chunk: int = 900, overlap: int = 150) -> List[str]:
-    out, i = [], 0
+    return list(_chunk_iter(text, chunk, overlap))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_tokenizer() -> Tokenizer:
+    from tokenizers import Tokenizer
+    if os.path.isfile(CHUNK_TOKENIZER):
+        return Tokenizer.from_file(CHUNK_TOKENIZER)
+    return Tokenizer.from_pretrained(CHUNK_TOKENIZER)
+
+
+def _chunk_tokens(text: str, chunk: int, overlap: int) -> List[str]:
+    """Split into windows of `chunk` tokens overlapping by `overlap`,
+    tokenizing once and slicing the original text on token offsets."""
+    enc = _get_tokenizer().encode(text, add_special_tokens=False)
+    offsets = np.asarray(enc.offsets, dtype=np.int64).reshape(-1, 2)
+    n = len(offsets)
+    if n == 0:
+        return []
     step = max(1, chunk - overlap)
-    n = len(text)
-    while i < n:
-        piece = text[i:i + chunk]
-        if not piece.strip():
-            break
-        out.append(piece)
-        i += step
-    return out
+    # A window starting at or past n - overlap would only repeat the tail
+    starts = np.arange(0, max(n - overlap, 1), step)
+    ends = np.minimum(starts + chunk, n) - 1
+    begin, end = offsets[starts, 0].tolist(), offsets[ends, 1].tolist()
+    return [text[b:e] for b, e in zip(begin, end)]
+
+
+def _split_text(text: str) -> Iterable[str]:
+    if CHUNK_TOKENS > 0:
+        return _chunk_tokens(text, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+    return _chunk_iter(text)
+
+
+def _chunk_stream(pieces: Iterable[str], chunk: int = 900, overlap: int = 150) -> Iterator[str]:
+    """Chunk text arriving in pieces (e.g. PDF pages) as if they were joined
+    with newlines and stripped; only the unconsumed tail is kept in memory."""
+    step = max(1, chunk - overlap)
+    buf = ""
+    started = False
+    for piece in pieces:
+        if started:
+            buf += "\n" + piece
+        else:
+            buf = piece.lstrip()
+            started = bool(buf)
+        pos = 0
+        # More text may still follow, so only emit windows that are complete;
+        # one reaching into trailing whitespace waits, since the final strip
+        # may cut it short
+        end = len(buf.rstrip())
+        while end - pos >= chunk:
+            yield buf[pos:pos + chunk]
+            pos += step
+        buf = buf[pos:]
+    if buf:
+        yield from _chunk_iter(buf.rstrip(), chunk, overlap)
+
+
+def _json_dumps(value: Any) -> str:
+    """Compact UTF-8 JSON; tolerates YAML's non-string keys and odd values."""
+    return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
 
 
 def _coerce_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
@@ -117,10 +395,12 @@ def _coerce_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
     Convert lists/dicts/dates to JSON/ISO strings."""
     fixed: Dict[str, Any] = {}
     for k, v in (meta or {}).items():
-        if isinstance(v, (str, int, float, bool)) or v is None:
+        if type(v) in _SCALAR_TYPES:  # common case, incl. already-coerced metadata
+            fixed[k] = v
+        elif isinstance(v, (str, int, float, bool)):
             fixed[k] = v
         elif isinstance(v, (list, dict)):
-            fixed[k] = json.dumps(v, ensure_ascii=False)
+            fixed[k] = _json_dumps(v)
         elif isinstance(v, (datetime.date, datetime.datetime)):
             fixed[k] = v.isoformat()
         else:
@@ -128,80 +408,141 @@ def _coerce_meta(meta: Dict[str, Any]) -> Dict[str, Any]:
     return fixed
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
 def _extract_json(text: str) -> Any:
     """Try hard to extract a JSON object from model output."""
     # 1) direct
     try:
-        return json.loads(text)
+        return orjson.loads(text)
     except Exception:
         pass
-    # 2) fenced ```json ... ```
-    m = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, flags=re.DOTALL)
-    if m:
+    # 2) drop ```json fences, then decode the first complete {...} object;
+    #    raw_decode stops at its end, so trailing chatter is ignored
+    text = text.replace("```json", "").replace("```", "")
+    i = text.find("{")
+    while i != -1:
         try:
-            return json.loads(m.group(1))
-        except Exception:
-            pass
-    # 3) first {...} block
-    m = re.search(r"(\{.*\})", text, flags=re.DOTALL)
-    if m:
-        try:
-            return json.loads(m.group(1))
-        except Exception:
-            pass
+            obj, _ = _JSON_DECODER.raw_decode(text, i)
+            return obj
+        except json.JSONDecodeError:
+            i = text.find("{", i + 1)
     return None
 
 
 # -----------------------
 # File Format Readers
 # -----------------------
-def _read_pdf(path: Path) -> str:
-    """Extract text from PDF file."""
-    text_parts = []
+# The binary readers take a path or an open binary file object (an upload,
+# an mmap-backed buffer). A file object is read from its current position
+# and left open for the caller.
+_Source = Union[Path, BinaryIO]
+
+
+def _source_name(src: _Source) -> str:
+    name = src.name if isinstance(src, Path) else getattr(src, "name", None)
+    return Path(name).name if isinstance(name, str) else "<stream>"
+
+
+@contextlib.contextmanager
+def _open_binary(src: _Source) -> Iterator[BinaryIO]:
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, "rb") as f:
+            yield f
+    else:
+        yield src
+
+
+def _iter_pdf_pages(src: _Source) -> Iterator[str]:
+    """Yield the extracted text of each non-empty PDF page."""
     try:
-        with open(path, "rb") as f:
+        with _open_binary(src) as f:
             reader = PdfReader(f)
             for page in reader.pages:
                 text = page.extract_text()
                 if text:
-                    text_parts.append(text)
+                    yield text
     except Exception as e:
-        raise ValueError(f"Failed to read PDF {path.name}: {e}")
-    return "\n".join(text_parts).strip()
+        raise ValueError(f"Failed to read PDF {_source_name(src)}: {e}")
+
+
+def _read_pdf(src: _Source) -> str:
+    """Extract text from PDF file."""
+    return "\n".join(_iter_pdf_pages(src)).strip()
 
 
-def _read_docx(path: Path) -> str:
+def _read_docx(src: _Source) -> str:
     """Extract text from DOCX file."""
     try:
-        text = docx2txt.process(str(path))
+        with _open_binary(src) as f:
+            text = docx2txt.process(f)
         return (text or "").strip()
     except Exception as e:
-        raise ValueError(f"Failed to read DOCX {path.name}: {e}")
+        raise ValueError(f"Failed to read DOCX {_source_name(src)}: {e}")
+
+
+def _rows_to_csv(rows: Iterable[Iterable[Any]]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(rows)
+    return buf.getvalue()
+
 
+def _sheet_text(title: str, rows: Iterable[Sequence[Any]]) -> str:
+    # Header + first 200 rows, first 30 columns, to avoid huge text
+    cells = (["" if v is None else v for v in row[:30]] for row in itertools.islice(rows, 201))
+    return f"# Sheet: {title}\n{_rows_to_csv(cells)}"
 
-def _read_excel(path: Path) -> str:
-    """Extract text from Excel file (XLSX/XLS). Flattens all sheets to CSV-like text."""
+
+def _read_excel(src: _Source) -> str:
+    """Extract text from Excel file (XLSX/XLS). Flattens all sheets to CSV-like text.
+    Uses python-calamine (>= 0.2) when installed, else openpyxl/pandas.
+    A file object is read as OOXML unless calamine is installed."""
+    if isinstance(src, (str, os.PathLike)):
+        src = Path(src)  # a str path must not reach the file-object readers
     try:
-        dfs = pd.read_excel(path, sheet_name=None)
-        parts = []
-        for sheet_name, df in dfs.items():
-            # Limit to first 200 rows and 30 columns to avoid huge text
-            limited_df = df.iloc[:200, :30]
-            parts.append(f"# Sheet: {sheet_name}\n{limited_df.to_csv(index=False)}")
+        if CalamineWorkbook is not None:
+            if isinstance(src, Path):
+                wb = CalamineWorkbook.from_path(str(src))
+            else:
+                wb = CalamineWorkbook.from_filelike(src)
+            return "\n\n".join(
+                _sheet_text(name, wb.get_sheet_by_name(name).iter_rows())
+                for name in wb.sheet_names
+            ).strip()
+
+        if isinstance(src, Path) and src.suffix.lower() == ".xls":
+            # Legacy binary format: openpyxl only reads OOXML, so use pandas
+            dfs = pd.read_excel(src, sheet_name=None)
+            return "\n\n".join(
+                f"# Sheet: {name}\n{df.iloc[:200, :30].to_csv(index=False)}"
+                for name, df in dfs.items()
+            ).strip()
+
+        # read_only streams rows without building the full cell grid
+        wb = load_workbook(src, read_only=True, data_only=True)
+        try:
+            parts = [_sheet_text(ws.title, ws.iter_rows(values_only=True)) for ws in wb.worksheets]
+        finally:
+            wb.close()
         return "\n\n".join(parts).strip()
     except Exception as e:
-        raise ValueError(f"Failed to read Excel {path.name}: {e}")
+        raise ValueError(f"Failed to read Excel {_source_name(src)}: {e}")
 
 
-def _read_csv(path: Path) -> str:
+def _read_csv(src: _Source) -> str:
     """Extract text from CSV file."""
     try:
-        df = pd.read_csv(path)
-        # Limit to first 10000 rows and 30 columns
-        limited_df = df.iloc[:10000, :30]
-        return limited_df.to_csv(index=False).strip()
+        with _open_binary(src) as raw:
+            f = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+            try:
+                # Header + first 10000 rows, first 30 columns; stop reading there
+                rows = itertools.islice(csv.reader(f), 10001)
+                return _rows_to_csv(row[:30] for row in rows).strip()
+            finally:
+                f.detach()  # closing the wrapper would close `raw`
     except Exception as e:
-        raise ValueError(f"Failed to read CSV {path.name}: {e}")
+        raise ValueError(f"Failed to read CSV {_source_name(src)}: {e}")
 
 
 def _detect_and_read_file(path: Path) -> str:
@@ -223,80 +564,622 @@ def _detect_and_read_file(path: Path) -> str:
         return _read_pdf(path)
     
     # Last resort: read as text
-    return path.read_text(encoding="utf-8", errors="ignore")
+    return _read_text(path, errors="ignore")
+
+
+def _read_text(path: Path, errors: str = "strict") -> str:
+    """Decode a UTF-8 file straight from a read-only mmap: the page cache
+    backs the bytes, so the only copy made is the str itself. Newlines are
+    normalized to "\n" like Path.read_text does."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""  # mmap rejects empty files
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = str(mm, "utf-8", errors)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+@functools.lru_cache(maxsize=256)
+def _load_markdown(path: str, mtime_ns: int, size: int) -> Tuple[Dict[str, Any], str]:
+    """Parse YAML front-matter + body. mtime/size are part of the cache key,
+    so an unchanged file is neither re-read nor re-parsed."""
+    post = frontmatter.loads(_read_text(Path(path)))
+    return dict(post.metadata or {}), post.content
 
 
 # -----------------------
 # Ingestion
 # -----------------------
-def ingest_text(text: str, metadata: Dict[str, Any]) -> Dict[str, Any]:
-    """Ingest raw text with metadata (used by API /ingest)."""
-    _, collection = _init_chroma()
+def _write_chunks(collection: Collection, ids: List[str], documents: List[str],
+                  embeddings: np.ndarray, metadatas: List[Dict[str, Any]]) -> None:
+    # upsert: re-ingesting a document overwrites its chunks in place (and
+    # ingest_stream deletes any left past the new chunk count)
+    collection.upsert(ids=ids, documents=documents, embeddings=embeddings,
+                      metadatas=cast(Metadatas, metadatas))
+    _mirror_to_vector_index(collection, ids, embeddings)
+
+
+@dataclass
+class BatchBuffer:
+    """Embedded chunks from any number of ingest calls, written to Chroma in
+    one upsert per `flush_at` chunks instead of one per call. Thread-safe;
+    call flush() once at the end, after every ingest call has returned: it
+    writes the remainder and then deletes the chunks of each written
+    document left over from an earlier, longer version of it.
+    Each call tags its rows with a `source` (e.g. the file path). A failed
+    write drops its rows and records the error in `failed[source]` for every
+    source in it, instead of raising into whichever call triggered it, and
+    a source whose ingest fails partway is handed to discard(). Either way
+    the source's rows are dropped, its already written chunks deleted again
+    and its later calls ignored: a source is fully stored once its rows are
+    written and it is not in `failed`, and absent otherwise.
+    Files can share a doc_id (cv.pdf, cv.docx): the document is then taken
+    from one of them, the one ranked last in `order` (source -> position,
+    e.g. the ingest order) or, for sources not in it, the last to arrive.
+    The others are recorded in `superseded[source]` with the winner, and
+    their rows are dropped rather than mixed into it."""
+    flush_at: int = BULK_FLUSH_CHUNKS
+    order: Dict[str, int] = field(default_factory=dict)
+    ids: List[str] = field(default_factory=list)
+    documents: List[str] = field(default_factory=list)
+    embeddings: List[np.ndarray] = field(default_factory=list)
+    metadatas: List[Dict[str, Any]] = field(default_factory=list)
+    sources: List[str] = field(default_factory=list)
+    docs: List[str] = field(default_factory=list)  # id prefix of each row
+    failed: Dict[str, Exception] = field(default_factory=dict)
+    superseded: Dict[str, str] = field(default_factory=dict)
+    _id_set: set = field(default_factory=set, repr=False)
+    # doc -> ids written so far, and the filter to find all of its chunks
+    _written: Dict[str, set] = field(default_factory=dict, repr=False)
+    _where: Dict[str, Optional[Dict[str, Any]]] = field(default_factory=dict, repr=False)
+    _doc_source: Dict[str, str] = field(default_factory=dict, repr=False)
+    _arrival: Dict[str, int] = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def extend(self, ids: List[str], documents: List[str], embeddings: np.ndarray,
+               metadatas: List[Dict[str, Any]], source: str = "", doc: str = "") -> None:
+        with self._lock:
+            if source in self.superseded or source in self.failed:
+                return
+            self._arrival.setdefault(source, len(self._arrival))
+            owner = self._doc_source.get(doc, source)
+            if owner != source:
+                if self._rank(source) < self._rank(owner):
+                    self.superseded[source] = owner
+                    return
+                # The new source replaces the document: the owner's pending
+                # rows are dropped and whatever it already wrote becomes the
+                # stale tail that flush() deletes
+                self.superseded[owner] = source
+                self._drop_pending_locked(lambda row_doc, _src: row_doc == doc)
+                self._written.pop(doc, None)
+            # A title-keyed and a doc_id-keyed document can still share an
+            # id prefix; Chroma rejects an upsert that repeats an id
+            if not self._id_set.isdisjoint(ids):
+                self._flush_locked()
+            if metadatas:
+                self._where.setdefault(doc, _doc_where(metadatas[0]))
+            self._doc_source[doc] = source
+            self.ids.extend(ids)
+            self._id_set.update(ids)
+            self.documents.extend(documents)
+            self.embeddings.extend(np.asarray(embeddings, dtype=np.float32))
+            self.metadatas.extend(metadatas)
+            self.sources.extend([source] * len(ids))
+            self.docs.extend([doc] * len(ids))
+            if len(self.ids) >= self.flush_at:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+            self._drop_stale_locked()
+
+    def discard(self, source: str, exc: Exception) -> None:
+        """Record that `source`'s ingest failed partway and roll it back."""
+        with self._lock:
+            self.failed.setdefault(source, exc)
+            self._drop_pending_locked(lambda _doc, src: src == source)
+            self._roll_back_locked({source})
+
+    def _roll_back_locked(self, sources: set) -> None:
+        """Delete the documents these sources own that were partly written,
+        as an unbuffered ingest does. Best effort: the sources are already
+        in `failed`."""
+        removed = 0
+        for doc, owner in list(self._doc_source.items()):
+            if owner not in sources:
+                continue
+            del self._doc_source[doc]
+            written = self._written.pop(doc, set())
+            if not written:
+                continue
+            where = self._where.get(doc)
+            try:
+                _, collection = _init_chroma()
+                if where is not None:
+                    written |= set(collection.get(where=where, include=[])["ids"])
+                removed += _delete_chunks(collection, sorted(written))
+            except Exception:
+                continue
+        if removed:
+            _on_corpus_changed()
+
+    def _rank(self, source: str) -> Tuple[bool, int]:
+        return source not in self.order, self.order.get(source, self._arrival[source])
+
+    def _drop_pending_locked(self, drop: Callable[[str, str], bool]) -> None:
+        """Remove the buffered rows for which drop(doc, source) is true."""
+        keep = [n for n, row in enumerate(zip(self.docs, self.sources)) if not drop(*row)]
+        self.ids = [self.ids[n] for n in keep]
+        self.documents = [self.documents[n] for n in keep]
+        self.embeddings = [self.embeddings[n] for n in keep]
+        self.metadatas = [self.metadatas[n] for n in keep]
+        self.sources = [self.sources[n] for n in keep]
+        self.docs = [self.docs[n] for n in keep]
+        self._id_set = set(self.ids)
+
+    def _flush_locked(self) -> None:
+        if not self.ids:
+            return
+        ids, documents, metadatas = self.ids, self.documents, self.metadatas
+        sources, docs = self.sources, self.docs
+        embeddings = np.vstack(self.embeddings)
+        self.ids, self.documents, self.embeddings, self.metadatas = [], [], [], []
+        self.sources, self.docs = [], []
+        self._id_set = set()
+        try:
+            _, collection = _init_chroma()
+            _write_chunks(collection, ids, documents, embeddings, metadatas)
+        except Exception as e:
+            for src in set(sources):
+                self.failed.setdefault(src, e)
+            self._roll_back_locked(set(sources))
+            return
+        for i, doc in zip(ids, docs):
+            self._written.setdefault(doc, set()).add(i)
+        _on_corpus_changed()
+
+    def _drop_stale_locked(self) -> None:
+        """Delete each written document's chunks that this buffer did not
+        write: the tail of an earlier version with more chunks."""
+        written, self._written = self._written, {}
+        removed = 0
+        for doc, current in written.items():
+            where = self._where.get(doc)
+            if where is None:
+                continue
+            try:
+                _, collection = _init_chroma()
+                stale = [i for i in collection.get(where=where, include=[])["ids"] if i not in current]
+                removed += _delete_chunks(collection, stale)
+            except Exception as e:
+                self.failed.setdefault(self._doc_source.get(doc, ""), e)
+        if removed:
+            _on_corpus_changed()
+
+
+def _id_batches(chunks: Iterable[str], prefix: str) -> Iterator[Tuple[List[str], List[str]]]:
+    """(ids, chunks) in groups of INGEST_BATCH; ids are "{prefix}-{n}"."""
+    it = iter(chunks)
+    start = 0
+    while True:
+        parts = list(itertools.islice(it, INGEST_BATCH))
+        if not parts:
+            return
+        yield [f"{prefix}-{i}" for i in range(start, start + len(parts))], parts
+        start += len(parts)
+
+
+def _doc_where(meta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Chroma filter matching every chunk of the document `meta` describes."""
+    if meta.get("doc_id"):
+        return {"doc_id": meta["doc_id"]}
+    if meta.get("title"):
+        return {"title": meta["title"]}
+    return None
+
+
+def _delete_chunks(collection: Collection, ids: List[str]) -> int:
+    global _local_count
+    if not ids:
+        return 0
+    collection.delete(ids=ids)
+    with _local_lock:
+        if _vector_index is not None:
+            _vector_index.remove(ids)
+            _local_count = collection.count()
+    return len(ids)
+
+
+def ingest_stream(chunks: Iterable[str], metadata: Dict[str, Any],
+                  buffer: Optional[BatchBuffer] = None, source: str = "") -> Dict[str, Any]:
+    """Embed and upsert chunks INGEST_BATCH at a time, so peak memory is one
+    batch rather than the whole document. Each batch's Chroma write runs
+    in the background while the next batch is being embedded.
+    With a `buffer`, chunks are handed to it instead (tagged with `source`,
+    the doc id if not given) and written when it fills up or is flushed;
+    check `buffer.failed` after the flush before reporting them as stored.
+    A failure partway through (an unreadable late PDF page, Ollama going
+    away) deletes the document's chunks again before the error propagates
+    (with a buffer: drops them from it too): it is left absent, never
+    half-written."""
     meta = _coerce_meta(metadata or {})
-    parts = _chunk(text)
-    ids = [f"{meta.get('doc_id', meta.get('title', 'doc'))}-{i}" for i in range(len(parts))]
-    embs = embed_texts(parts)
-    metas = [meta] * len(parts)
-    collection.add(ids=ids, documents=parts, embeddings=embs, metadatas=metas)
-    return {"added": len(parts)}
+    prefix = meta.get("doc_id") or meta.get("title") or "doc"
+    added = 0
+    # Every chunk of a document shares the one `meta` dict (a list of
+    # references, not copies); Chroma only reads it.
+    if buffer is not None:
+        source = source or prefix
+        try:
+            for ids, parts in _id_batches(chunks, prefix):
+                buffer.extend(ids, parts, embed_texts(parts), [meta] * len(parts), source, prefix)
+                added += len(parts)
+        except Exception as e:
+            buffer.discard(source, e)
+            raise
+        return {"added": added}
+
+    _, collection = _init_chroma()
+    pending = None
+    written: List[str] = []
+    removed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-add") as writer:
+            for ids, parts in _id_batches(chunks, prefix):
+                embs = embed_texts(parts)
+                if pending is not None:
+                    pending.result()  # at most one write in flight; surfaces errors
+                pending = writer.submit(_write_chunks, collection, ids, parts, embs, [meta] * len(parts))
+                written.extend(ids)
+                added += len(parts)
+            if pending is not None:
+                pending.result()
+        # Re-ingesting an edited document that now has fewer chunks: its old
+        # tail ids were not overwritten, so drop them
+        where = _doc_where(meta)
+        if where is not None:
+            current = set(written)
+            removed = _delete_chunks(collection, [
+                i for i in collection.get(where=where, include=[])["ids"] if i not in current
+            ])
+    except Exception:
+        # The executor has drained, so every submitted write has settled
+        if written:
+            where = _doc_where(meta)
+            if where is not None:
+                stale = collection.get(where=where, include=[])["ids"]
+                _delete_chunks(collection, list(set(stale) | set(written)))
+            else:
+                _delete_chunks(collection, written)
+        raise
+    finally:
+        if added or removed:
+            _on_corpus_changed()
+    return {"added": added}
 
 
-def ingest_file(filepath: str) -> Dict[str, Any]:
-    """Ingest a file (Markdown, PDF, DOCX, XLSX, CSV) with metadata.
-    For Markdown: YAML front-matter becomes metadata, body is embedded.
-    For other formats: text extracted and embedded with basic metadata."""
+def ingest_text(text: str, metadata: Dict[str, Any],
+                buffer: Optional[BatchBuffer] = None, source: str = "") -> Dict[str, Any]:
+    """Ingest raw text with metadata (used by API /ingest)."""
+    return ingest_stream(_split_text(text), metadata, buffer=buffer, source=source)
+
+
+def _file_meta(p: Path) -> Dict[str, Any]:
+    return _coerce_meta({
+        "filename": p.name,
+        "type": "file",
+        "doc_id": p.stem,
+        "source_ext": p.suffix.lower().lstrip("."),
+    })
+
+
+def parse_file(filepath: Union[str, os.PathLike]) -> Tuple[str, Dict[str, Any]]:
+    """Read a file into (text, metadata) without touching Chroma or Ollama,
+    so it can run in a worker process.
+    For Markdown: YAML front-matter becomes metadata.
+    For other formats: extracted text with basic metadata."""
     # Validate and resolve path
     p = _validate_file_path(filepath)
-    
+
     # Handle Markdown files with YAML frontmatter
     if p.suffix.lower() == ".md":
-        post = frontmatter.loads(p.read_text(encoding="utf-8"))
-        meta = _coerce_meta(dict(post.metadata or {}))
+        st = p.stat()
+        fm_meta, content = _load_markdown(str(p), st.st_mtime_ns, st.st_size)
+        meta = _coerce_meta(fm_meta)
         # defaults
         meta.setdefault("filename", p.name)
         meta.setdefault("type", "markdown")
         meta.setdefault("doc_id", p.stem)
-        return ingest_text(post.content, meta)
-    
+        return content, meta
+
     # Handle other file formats
     try:
         body = _detect_and_read_file(p)
     except Exception as e:
         raise ValueError(f"Failed to read {p.name}: {e}")
-    
-    meta = _coerce_meta({
-        "filename": p.name,
-        "type": "file",
-        "doc_id": p.stem,
-        "source_ext": p.suffix.lower().lstrip("."),
-    })
-    return ingest_text(body or "", meta)
+    return body or "", _file_meta(p)
+
+
+def ingest_file(filepath: Union[str, os.PathLike],
+                buffer: Optional[BatchBuffer] = None) -> Dict[str, Any]:
+    """Ingest a file (Markdown, PDF, DOCX, XLSX, CSV) with metadata.
+    For Markdown: YAML front-matter becomes metadata, body is embedded.
+    For other formats: text extracted and embedded with basic metadata."""
+    p = _validate_file_path(filepath)
+
+    # PDFs can be huge: stream pages straight into the (character) chunker
+    if p.suffix.lower() == ".pdf" and CHUNK_TOKENS <= 0:
+        return ingest_stream(_chunk_stream(_iter_pdf_pages(p)), _file_meta(p),
+                             buffer=buffer, source=str(p))
+
+    text, meta = parse_file(p)
+    return ingest_text(text, meta, buffer=buffer, source=str(p))
 
 
 # -----------------------
 # Retrieval
 # -----------------------
-def search(query: str, k: int = 8) -> List[Dict[str, Any]]:
+@functools.lru_cache(maxsize=512)
+def _embed_query(text: str) -> np.ndarray:
+    """Query embeddings are deterministic per model, so repeats skip Ollama.
+    The cached vector is shared between callers, hence read-only."""
+    emb = np.asarray(embed_texts([text])[0], dtype=np.float32)
+    emb.flags.writeable = False
+    return emb
+
+
+def _query_chroma(query: str, k: int) -> List[Dict[str, Any]]:
     _, collection = _init_chroma()
-    emb = embed_texts([query])[0]
+    emb = _embed_query(query)
     res = collection.query(
-        query_embeddings=[emb],
+        query_embeddings=[emb.tolist()],
         n_results=k,
-        include=["documents", "metadatas", "distances"],
+        include=[IncludeEnum.documents, IncludeEnum.metadatas, IncludeEnum.distances],
+    )
+    ids = (res.get("ids") or [[]])[0]
+    docs = (res.get("documents") or [[]])[0]
+    metas = (res.get("metadatas") or [[]])[0]
+    dists = (res.get("distances") or [[]])[0]
+    return [
+        {"id": i, "text": d, "metadata": m, "distance": dist}
+        for i, d, m, dist in zip(ids, docs, metas, dists)
+    ]
+
+
+def _get_neighbor_table(create: bool = False) -> Optional[NeighborTable]:
+    """Open the hot-query table; unless `create`, only if it already exists."""
+    global _neighbor_table
+    if _neighbor_table is None and (create or os.path.exists(NEIGHBOR_TABLE_PATH)):
+        with _neighbor_table_lock:
+            if _neighbor_table is None:
+                _neighbor_table = NeighborTable(NEIGHBOR_TABLE_PATH)
+    return _neighbor_table
+
+
+def _precomputed_search(query: str, k: int) -> Optional[List[Dict[str, Any]]]:
+    table = _get_neighbor_table()
+    stored = table.get(query) if table is not None else None
+    if stored is None or stored[0] < k:
+        return None
+    _, collection = _init_chroma()
+    return _fetch_hits(collection, stored[1][:k])
+
+
+def _fetch_hits(collection: Collection, hits: List[Tuple[str, float]]) -> Optional[List[Dict[str, Any]]]:
+    """Hit dicts for (id, distance) pairs, in that order; None if any chunk
+    no longer exists."""
+    res = collection.get(ids=[i for i, _ in hits], include=[IncludeEnum.documents, IncludeEnum.metadatas])
+    rows = dict(zip(res.get("ids") or [], zip(res.get("documents") or [], res.get("metadatas") or [])))
+    if len(rows) < len(hits):
+        return None  # some chunks were deleted since the ids were recorded
+    return [
+        {"id": i, "text": rows[i][0], "metadata": rows[i][1], "distance": d}
+        for i, d in hits
+    ]
+
+
+def precompute_neighbors(queries: List[str], k: int = 8) -> int:
+    """Store top-k hits for known hot queries so search() skips the HNSW
+    walk for them. Ingesting clears the table; rerun this afterwards."""
+    table = _get_neighbor_table(create=True)
+    assert table is not None
+    for q in queries:
+        hits = _query_chroma(q, k)
+        table.put(q, k, [(h["id"], h["distance"]) for h in hits])
+    return len(queries)
+
+
+def _build_vector_index(collection: Collection) -> Optional[VectorIndex]:
+    index: Optional[VectorIndex] = None
+    offset = 0
+    while True:
+        page = collection.get(include=[IncludeEnum.embeddings], limit=_INDEX_PAGE, offset=offset)
+        ids = page.get("ids") or []
+        if not ids:
+            return index
+        embs = np.asarray(page["embeddings"], dtype=np.float32)
+        if index is None:
+            index = VectorIndex(embs.shape[1], capacity=collection.count())
+        index.add(ids, embs)
+        offset += len(ids)
+
+
+def _refresh_local_index(collection: Collection) -> None:
+    """(Re)build the local index when the collection size or the corpus
+    stamp no longer matches: an exact MatrixIndex up to MATRIX_SEARCH_MAX_N
+    chunks, an hnswlib VectorIndex above that. The check also catches
+    writes made by other processes (bulk_ingest), including same-size
+    re-ingests, so it clears the query cache too."""
+    global _matrix_index, _vector_index, _local_count, _local_stamp
+    if MATRIX_SEARCH_MAX_N <= 0:
+        return
+    n, stamp = collection.count(), _corpus_stamp()
+    if n == _local_count and stamp == _local_stamp:
+        return
+    with _local_lock:
+        if n == _local_count and stamp == _local_stamp:
+            return
+        if _query_cache is not None:
+            _query_cache.clear()
+        _matrix_index = _vector_index = None
+        if n <= MATRIX_SEARCH_MAX_N:
+            res = collection.get(include=[IncludeEnum.embeddings, IncludeEnum.documents, IncludeEnum.metadatas])
+            _matrix_index = MatrixIndex(res["ids"], res["documents"] or [], res["metadatas"] or [], res["embeddings"])
+        elif LOCAL_HNSW:
+            _vector_index = _build_vector_index(collection)
+        _local_count, _local_stamp = n, stamp
+
+
+def _mirror_to_vector_index(collection: Collection, ids: List[str], embeddings: np.ndarray) -> None:
+    """Apply our own write to the live hnswlib index instead of rebuilding it."""
+    global _local_count
+    if _vector_index is None:
+        return
+    with _local_lock:
+        if _vector_index is not None:
+            _vector_index.add(ids, embeddings)
+            _local_count = collection.count()
+
+
+def _local_search(collection: Collection, emb: np.ndarray, k: int) -> Optional[List[Dict[str, Any]]]:
+    matrix, vectors = _matrix_index, _vector_index
+    if matrix is not None:
+        return matrix.search(emb, k)
+    if vectors is not None:
+        return _fetch_hits(collection, vectors.search(emb, k))
+    return None
+
+
+def search(query: str, k: int = 8) -> List[Dict[str, Any]]:
+    hot = _precomputed_search(query, k)
+    if hot is not None:
+        return hot
+    _, collection = _init_chroma()
+    _refresh_local_index(collection)
+    if _query_cache is None and _matrix_index is None and _vector_index is None:
+        return _query_chroma(query, k)
+    emb = _embed_query(query)
+    hits = _query_cache.get(emb, k) if _query_cache is not None else None
+    if hits is None:
+        hits = _local_search(collection, emb, k)
+        if hits is None:
+            hits = _query_chroma(query, k)
+        if _query_cache is not None:
+            _query_cache.put(emb, k, hits)
+    return hits
+
+
+# -----------------------
+# Response cache
+# -----------------------
+def _response_cache() -> Collection:
+    """Sidecar collection of (job_post embedding -> generated draft).
+    Looked up by name on every call rather than held: bulk_ingest resets it
+    from another process, and a held handle would keep answering from the
+    deleted collection's in-memory index."""
+    client, _ = _init_chroma()
+    return client.get_or_create_collection(
+        name=APPLY_CACHE_NAME, metadata={"hnsw:space": "cosine"}
+    )
+
+
+def _reset_response_cache() -> None:
+    """Drafts were built from the old corpus; drop them after an ingest."""
+    if APPLY_CACHE_MAX_DISTANCE <= 0:
+        return
+    client, _ = _init_chroma()
+    try:
+        client.delete_collection(APPLY_CACHE_NAME)
+    except ValueError:
+        pass  # never created
+
+
+def _corpus_count() -> int:
+    """Chunks in the main collection; stored with each draft so one built
+    from a different corpus is never served, whichever process changed it."""
+    _, collection = _init_chroma()
+    return collection.count()
+
+
+def _corpus_stamp() -> str:
+    try:
+        with open(CORPUS_STAMP_PATH, encoding="ascii") as f:
+            return f.read()
+    except OSError:
+        return ""  # no change recorded yet
+
+
+def _bump_corpus_stamp() -> str:
+    """Replace the stamp with a fresh token and return it. The chunk count
+    alone misses another process re-ingesting a document at the same size."""
+    stamp = uuid.uuid4().hex
+    tmp = f"{CORPUS_STAMP_PATH}.{stamp}.tmp"
+    try:
+        os.makedirs(os.path.dirname(CORPUS_STAMP_PATH) or ".", exist_ok=True)
+        with open(tmp, "w", encoding="ascii") as f:
+            f.write(stamp)
+        os.replace(tmp, CORPUS_STAMP_PATH)  # readers never see it half-written
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        return _corpus_stamp()
+    return stamp
+
+
+def _on_corpus_changed() -> None:
+    """Invalidate everything derived from the collection's contents."""
+    global _matrix_index, _local_count, _local_stamp
+    stamp = _bump_corpus_stamp()
+    _reset_response_cache()
+    if _query_cache is not None:
+        _query_cache.clear()
+    with _local_lock:
+        if _vector_index is None:
+            _matrix_index, _local_count = None, -1
+        else:  # the hnswlib index is kept current by our writes
+            _local_stamp = stamp
+    table = _get_neighbor_table()
+    if table is not None:
+        table.clear()
+
+
+def invalidate_caches() -> None:
+    """Call after changing the collection outside app.rag (e.g. deleting
+    documents), so no cached result refers to the old contents."""
+    global _vector_index, _local_count
+    with _local_lock:
+        _vector_index, _local_count = None, -1
+    _on_corpus_changed()
+
+
+def _lookup_cached_draft(emb: np.ndarray, corpus_count: int) -> Optional[Dict[str, Any]]:
+    if APPLY_CACHE_MAX_DISTANCE <= 0:
+        return None
+    res = _response_cache().query(
+        query_embeddings=[emb.tolist()], n_results=1, include=[IncludeEnum.metadatas, IncludeEnum.distances]
+    )
+    dists = (res.get("distances") or [[]])[0]
+    metas = (res.get("metadatas") or [[]])[0]
+    if (dists and metas and dists[0] < APPLY_CACHE_MAX_DISTANCE
+            and metas[0].get("corpus_count") == corpus_count):
+        return orjson.loads(str(metas[0]["draft"]))
+    return None
+
+
+def _store_draft(emb: np.ndarray, draft: Dict[str, Any], corpus_count: int) -> None:
+    if APPLY_CACHE_MAX_DISTANCE <= 0:
+        return
+    _response_cache().add(
+        ids=[uuid.uuid4().hex],
+        embeddings=[emb.tolist()],
+        metadatas=[{"draft": _json_dumps(draft), "corpus_count": corpus_count}],
     )
-    out: List[Dict[str, Any]] = []
-    ids = res.get("ids", [[]])[0]
-    docs = res.get("documents", [[]])[0]
-    metas = res.get("metadatas", [[]])[0]
-    dists = res.get("distances", [[]])[0]
-    for i in range(len(ids)):
-        out.append({
-            "id": ids[i],
-            "text": docs[i],
-            "metadata": metas[i],
-            "distance": dists[i],
-        })
-    return out
 
 
 # -----------------------
@@ -307,49 +1190,118 @@ SYSTEM = (
     "Be concise, include measurable achievements, keep facts truthful, avoid clichés."
 )
 
-PROMPT = """You are given a NEW JOB POST and a set of RELEVANT MATERIAL (snippets from my past applications/CV).
+# Static instructions + schema. Kept byte-identical across calls and sent as
+# the system message, so Ollama can reuse its KV cache for this prefix.
+PROMPT_STATIC_PREFIX = """You are given a NEW JOB POST and a set of RELEVANT MATERIAL (snippets from my past applications/CV).
 Return a STRICT JSON object with EXACTLY these keys:
 
-{{
+{
   "cover_letter_markdown": string,   // 250–350 words, use Markdown, no salutations beyond Dear Hiring Manager
   "cv_bullets": [                    // 6–10 concise bullets with metrics
     "..."
   ],
-  "ats_report": {{
+  "ats_report": {
     "covered": ["..."],              // job keywords present in the draft
     "missing": ["..."]               // important job keywords not covered
-  }}
-}}
+  }
+}
 
 Rules:
 - Output ONLY valid JSON (no markdown fences).
 - Keep facts accurate and aligned with RELEVANT MATERIAL.
+- RELEVANT MATERIAL is given as <doc id="..."> blocks, one per source document.
+"""
 
-NEW JOB POST:
-{job_post}
+_SYSTEM_PROMPT = SYSTEM + "\n\n" + PROMPT_STATIC_PREFIX
 
-RELEVANT MATERIAL (top matches from user's past applications/CV):
-{context}
-"""
+def _build_messages(job_post: str, context: str) -> List[Dict[str, str]]:
+    """Static system prompt, then context, then the job post: similar posts
+    retrieve the same context, so Ollama's prompt cache covers everything
+    up to the job post."""
+    user = (
+        "RELEVANT MATERIAL (top matches from user's past applications/CV):\n"
+        + context
+        + "\n\nNEW JOB POST:\n" + job_post + "\n"
+    )
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": user},
+    ]
 
 
-def generate_application(job_post: str) -> Dict[str, Any]:
-    top = search(job_post, k=8)
-    context = "\n\n---\n\n".join([t["text"] for t in top])
+def _chunk_id_key(chunk_id: str) -> Tuple[str, int]:
+    """Sort key for "{doc_id}-{n}" ids: by document, then chunk number."""
+    doc, _, n = chunk_id.rpartition("-")
+    return (doc, int(n)) if n.isdigit() else (chunk_id, -1)
 
-    messages = [
-        {"role": "system", "content": SYSTEM},
-        {"role": "user", "content": PROMPT.format(job_post=job_post, context=context)},
-    ]
 
-    # Ask Ollama to produce JSON; keep temperature low for compliance
-    resp = ollama.chat(
+def _format_context(top: List[Dict[str, Any]]) -> str:
+    """One <doc> block per source document, documents sorted by doc_id and
+    chunks in document order. Rank order is deliberately dropped: the same
+    hits always produce a byte-identical context, whatever their distances
+    to this post, which keeps Ollama's prompt cache warm across posts."""
+    docs: Dict[str, List[Dict[str, Any]]] = {}
+    for hit in top:
+        meta = hit.get("metadata") or {}
+        did = str(meta.get("doc_id") or _chunk_id_key(hit["id"])[0])
+        docs.setdefault(did.replace('"', "'"), []).append(hit)
+    blocks = []
+    for did in sorted(docs):
+        chunks = sorted(docs[did], key=lambda t: _chunk_id_key(t["id"]))
+        body = "\n\n---\n\n".join(t["text"] for t in chunks)
+        blocks.append(f'<doc id="{did}">\n{body}\n</doc>')
+    return "\n".join(blocks)
+
+
+def _count_tokens(text: str) -> int:
+    """Exact with the chunking tokenizer, else ~4 characters per token."""
+    if CHUNK_TOKENS > 0:
+        return len(_get_tokenizer().encode(text, add_special_tokens=False).ids)
+    return len(text) // 4 + 1
+
+
+def _is_near_duplicate(text: str, kept: List[str]) -> bool:
+    for other in kept:
+        sm = difflib.SequenceMatcher(None, text, other, autojunk=False)
+        # cheap upper bounds first; ratio() is the expensive one
+        if (sm.real_quick_ratio() > CONTEXT_DEDUP_RATIO
+                and sm.quick_ratio() > CONTEXT_DEDUP_RATIO
+                and sm.ratio() > CONTEXT_DEDUP_RATIO):
+            return True
+    return False
+
+
+def _select_context(top: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop near-duplicate hits, then greedily fill MAX_CTX_TOKENS in rank order."""
+    selected: List[Dict[str, Any]] = []
+    kept: List[str] = []
+    budget = MAX_CTX_TOKENS
+    for hit in top:
+        text = hit["text"]
+        if _is_near_duplicate(text, kept):
+            continue
+        cost = _count_tokens(text)
+        if cost > budget:
+            continue
+        budget -= cost
+        kept.append(text)
+        selected.append(hit)
+    return selected
+
+
+def _chat_kwargs(job_post: str) -> Dict[str, Any]:
+    top = _select_context(search(job_post, k=8))
+    # Ask Ollama to produce JSON; keep temperature low for compliance.
+    # keep_alive keeps the model (and its prompt-prefix KV cache) resident.
+    return dict(
         model=GEN_MODEL,
-        messages=messages,
-        options={"temperature": 0.2, "num_ctx": 4096, "format": "json"},
+        messages=_build_messages(job_post, _format_context(top)),
+        options={"temperature": 0.2, "num_ctx": GEN_NUM_CTX, "format": "json"},
+        keep_alive=GEN_KEEP_ALIVE,
     )
-    content = resp["message"]["content"]
 
+
+def _finish_draft(emb: np.ndarray, content: str, corpus_count: int) -> Dict[str, Any]:
     parsed = _extract_json(content)
     if isinstance(parsed, dict) and (
         "cover_letter_markdown" in parsed or "cv_bullets" in parsed or "ats_report" in parsed
@@ -358,7 +1310,41 @@ def generate_application(job_post: str) -> Dict[str, Any]:
         parsed.setdefault("cover_letter_markdown", parsed.get("cover_letter") or "")
         parsed.setdefault("cv_bullets", parsed.get("bullets") or [])
         parsed.setdefault("ats_report", parsed.get("ats") or {})
+        _store_draft(emb, parsed, corpus_count)
         return parsed
 
     # Still not valid JSON -> return raw text so UI can show something
     return {"raw": content}
+
+
+def generate_application(job_post: str) -> Dict[str, Any]:
+    # Near-duplicate job posts (reposts, small edits) reuse an earlier draft,
+    # if it was built from a corpus of the same size; counted before the
+    # search, so a draft is never tagged with a corpus it did not see
+    emb = _embed_query(job_post)
+    corpus_count = _corpus_count()
+    cached = _lookup_cached_draft(emb, corpus_count)
+    if cached is not None:
+        return cached
+
+    resp = cast(Mapping[str, Any], _ollama.chat(**_chat_kwargs(job_post)))
+    return _finish_draft(emb, resp["message"]["content"], corpus_count)
+
+
+def generate_application_stream(job_post: str) -> Iterator[Dict[str, Any]]:
+    """Like generate_application, but yields {"delta": text} events as the
+    model produces tokens, then one final {"draft": ...} event."""
+    emb = _embed_query(job_post)
+    corpus_count = _corpus_count()
+    cached = _lookup_cached_draft(emb, corpus_count)
+    if cached is not None:
+        yield {"draft": cached}
+        return
+
+    parts: List[str] = []
+    for chunk in cast(Iterator[Mapping[str, Any]], _ollama.chat(**_chat_kwargs(job_post), stream=True)):
+        delta = chunk.get("message", {}).get("content", "")
+        if delta:
+            parts.append(delta)
+            yield {"delta": delta}
+    yield {"draft": _finish_draft(emb, "".join(parts), corpus_count)}
@@ -1,22 +1,68 @@
-import requests, streamlit as st, json
-import json
+from typing import Any, Dict, Iterator
 
-raw = draft.get("raw")
-if raw and not draft.get("cover_letter_markdown"):
+import httpx
+import orjson
+import streamlit as st
+
+API_URL = "http://127.0.0.1:8000"
+
+
+@st.cache_resource
+def _client() -> httpx.Client:
+    # One pooled client per UI process: no TCP handshake per click
+    return httpx.Client(base_url=API_URL, timeout=180)
+
+
+def _stream_draft(job: str, result: Dict[str, Any]) -> Iterator[str]:
+    """Yield model output as it arrives from /apply/stream; the final draft
+    is stored in result["draft"], or a failure message in result["error"]."""
     try:
-        draft = json.loads(raw)
-    except Exception:
-        pass
+        with _client().stream("POST", "/apply/stream", json={"job_post": job}) as r:
+            if r.is_error:
+                r.read()
+                result["error"] = f"HTTP {r.status_code}: {r.text}"
+                return
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                event = orjson.loads(line)
+                if "delta" in event:
+                    yield event["delta"]
+                elif "draft" in event:
+                    result["draft"] = event["draft"]
+                elif "error" in event:
+                    result["error"] = event["error"]
+    except httpx.HTTPError as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    if "draft" not in result:
+        result.setdefault("error", "The stream ended without a draft.")
+
+
+def _normalize(draft: Dict[str, Any]) -> Dict[str, Any]:
+    raw = draft.get("raw")
+    if raw and not draft.get("cover_letter_markdown"):
+        try:
+            draft = orjson.loads(raw)
+        except Exception:
+            pass
+    return draft
+
 
 st.set_page_config(page_title="qPro", layout="wide")
 st.title("qPro — Tailored Job Application")
 
 job = st.text_area("Paste job post", height=260)
 if st.button("Generate"):
-    with st.spinner("Generating..."):
-        r = requests.post("http://127.0.0.1:8000/apply", json={"job_post": job}, timeout=180)
-        r.raise_for_status()
-        draft = r.json().get("draft", {})
+    result: Dict[str, Any] = {}
+    live = st.empty()
+    with live.container():
+        st.caption("Generating...")
+        st.write_stream(_stream_draft(job, result))
+    live.empty()
+    if "error" in result:
+        st.error(f"Generation failed: {result['error']}")
+        st.stop()
+    draft = _normalize(result["draft"])
     st.subheader("Cover Letter (Markdown)")
     st.code(draft.get("cover_letter_markdown", draft.get("raw","")), language="markdown")
     col1, col2 = st.columns(2)
@@ -0,0 +1,69 @@
+# app/vector_index.py
+from __future__ import annotations
+
+from typing import Dict, List, Sequence, Tuple
+import threading
+
+import hnswlib  # type: ignore[import-untyped]  # shipped with chromadb as chroma-hnswlib
+import numpy as np
+
+
+class VectorIndex:
+    """In-process hnswlib cosine index of chunk ids, for corpora too large
+    for an exact MatrixIndex scan. Writes can be mirrored in incrementally;
+    re-adding an id replaces its vector. Documents stay in Chroma."""
+
+    def __init__(self, dim: int, capacity: int = 1024, M: int = 32,
+                 ef_construction: int = 200, ef: int = 64):
+        self.dim = dim
+        self.ef = ef
+        self._lock = threading.Lock()
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(
+            max_elements=max(1, capacity), M=M, ef_construction=ef_construction
+        )
+        self._labels: Dict[str, int] = {}  # chunk id -> live label
+        self._ids: List[str] = []          # label -> chunk id
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def add(self, ids: Sequence[str], embeddings: np.ndarray) -> None:
+        if not len(ids):
+            return
+        data = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dim)
+        with self._lock:
+            for i in ids:
+                old = self._labels.pop(i, None)
+                if old is not None:
+                    self._index.mark_deleted(old)
+            start = len(self._ids)
+            needed = start + len(ids)
+            if needed > self._index.get_max_elements():
+                self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+            labels = np.arange(start, needed)
+            self._index.add_items(data, labels)
+            self._ids.extend(ids)
+            self._labels.update(zip(ids, labels.tolist()))
+
+    def remove(self, ids: Sequence[str]) -> None:
+        with self._lock:
+            for i in ids:
+                label = self._labels.pop(i, None)
+                if label is not None:
+                    self._index.mark_deleted(label)
+
+    def search(self, emb: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """[(chunk id, distance)] nearest first; distance is 2 - 2cos, the
+        scale Chroma uses for unit vectors in its default l2 space."""
+        q = np.asarray(emb, dtype=np.float32).reshape(1, self.dim)
+        with self._lock:
+            k = min(k, len(self._labels))
+            if k <= 0:
+                return []
+            self._index.set_ef(max(self.ef, k))
+            labels, dists = self._index.knn_query(q, k=k)
+            return [
+                (self._ids[label], max(0.0, 2.0 * d))
+                for label, d in zip(labels[0].tolist(), dists[0].tolist())
+            ]
@@ -18,10 +18,16 @@ Usage:
     python3 bulk_manage.py
 """
 
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import Any, List, Dict, Tuple
 
-from app.rag import ingest_file, _init_chroma
+from chromadb.api.types import IncludeEnum
+
+from app.rag import BatchBuffer, ingest_text, invalidate_caches, parse_file, _init_chroma, OLLAMA_NUM_PARALLEL
 
 # Supported file extensions
 EXTENSIONS = ["*.md", "*.pdf", "*.docx", "*.xlsx", "*.csv"]
@@ -43,35 +49,55 @@ def find_candidate_files() -> List[Path]:
     return files
 
 
+# Chunks fetched per collection.get() while listing documents
+LIST_PAGE_SIZE = 1000
+
+
 def list_ingested_docs() -> Dict[str, Tuple[str, str]]:
     """
     Return a mapping:
         doc_id -> (filename, source_ext)
-    from Chroma metadata.
+    from Chroma metadata, read in pages of LIST_PAGE_SIZE chunks so memory
+    stays bounded however large the collection is.
     """
     _, collection = _init_chroma()
-    data = collection.get(include=["metadatas"])
-    metas_list = data.get("metadatas", [])
-
-    # Chroma returns list-of-lists: [[meta1, meta2, ...]]
-    if metas_list and isinstance(metas_list[0], list):
-        metas = metas_list[0]
-    else:
-        metas = metas_list
-
     docs: Dict[str, Tuple[str, str]] = {}
-    for meta in metas:
-        if not isinstance(meta, dict):
-            continue
-        doc_id = meta.get("doc_id")
-        filename = meta.get("filename", "")
-        source_ext = meta.get("source_ext", "")
-        if doc_id:
-            docs[doc_id] = (str(filename), str(source_ext))
+    offset = 0
+    while True:
+        page = collection.get(include=[IncludeEnum.metadatas], limit=LIST_PAGE_SIZE, offset=offset)
+        metas = page.get("metadatas") or []
+        if not metas:
+            break
+        for meta in metas:
+            if not isinstance(meta, dict):
+                continue
+            doc_id = meta.get("doc_id")
+            # First chunk wins; the rest of a document's chunks repeat it
+            if doc_id and doc_id not in docs:
+                docs[doc_id] = (str(meta.get("filename", "")), str(meta.get("source_ext", "")))
+        if len(metas) < LIST_PAGE_SIZE:
+            break
+        offset += len(metas)
 
     return docs
 
 
+def _parse_file_worker(path: str) -> Tuple[str, str, Dict[str, Any]]:
+    """Runs in a worker process: file -> (path, text, metadata). Only plain
+    data is returned; no Chroma or Ollama handles cross the process boundary."""
+    text, meta = parse_file(path)
+    return path, text, meta
+
+
+def _ingest_parsed(parsed: "Future[Tuple[str, str, Dict[str, Any]]]", buffer: BatchBuffer) -> Any:
+    """Embed one parsed file; returns the result dict or the exception raised."""
+    try:
+        parsed_path, text, meta = parsed.result()
+        return ingest_text(text, meta, buffer=buffer, source=parsed_path)
+    except Exception as e:
+        return e
+
+
 def do_ingest():
     """Ingest all detected files, with checks and nice logging."""
     files = find_candidate_files()
@@ -92,22 +118,37 @@ def do_ingest():
         return
 
     print("\n🚀 Starting ingestion...")
-    for f in files:
-        rel = f
+    # PDF/DOCX/XLSX parsing is CPU-bound pure Python: spread it over worker
+    # processes ("spawn": this process already runs threads). Embedding runs
+    # on threads as each file's text arrives; app.rag caps concurrent Ollama
+    # requests at OLLAMA_NUM_PARALLEL. Chunks from all files share one
+    # buffer: one Chroma write per ~200 chunks. Files sharing a doc_id keep
+    # the one listed last, as ingesting them one by one would.
+    buffer = BatchBuffer(order={str(f): n for n, f in enumerate(files)})
+    n_parsers = max(1, min(len(files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(n_parsers, mp_context=multiprocessing.get_context("spawn")) as parsers, \
+            ThreadPoolExecutor(max_workers=max(1, OLLAMA_NUM_PARALLEL)) as pool:
+        parsed = [parsers.submit(_parse_file_worker, str(f)) for f in files]
+        results = list(pool.map(_ingest_parsed, parsed, itertools.repeat(buffer)))
+    buffer.flush()
+
+    # Only now is every chunk either in Chroma or recorded in buffer.failed
+    for rel, result in zip(files, results):
         print(f" → Adding {rel}")
-        try:
-            result = ingest_file(str(f))
+        if isinstance(result, Exception):
+            print(f"   ⚠️ Skipped {rel}: {result}")
+        elif str(rel) in buffer.failed:
+            print(f"   ⚠️ Write to Chroma failed for {rel}: {buffer.failed[str(rel)]}")
+        elif str(rel) in buffer.superseded:
+            print(f"   ↪️ Replaced by {buffer.superseded[str(rel)]} (same doc_id)")
+        else:
             print(f"   ✅ Added {result.get('added', 0)} chunks")
-        except Exception as e:
-            print(f"   ⚠️ Skipped {rel}: {e}")
 
     print("\n✅ Ingestion step complete!")
 
 
 def do_de_ingest():
     """Allow the user to de-ingest (delete) previously ingested documents."""
-    from app.rag import _init_chroma
-
     docs = list_ingested_docs()
     if not docs:
         print("⚠️  No ingested documents found in Chroma (collection is empty).")
@@ -138,6 +179,7 @@ def do_de_ingest():
             print("❎ De-ingest (delete all) cancelled.")
             return
         collection.delete(where={})
+        invalidate_caches()
         print("🧨 All documents deleted from Chroma collection.")
         return
 
@@ -160,6 +202,7 @@ def do_de_ingest():
         return
 
     collection.delete(where={"doc_id": doc_id})
+    invalidate_caches()
     print(f"🗑 Deleted all chunks with doc_id={doc_id!r}")
 
 
@@ -0,0 +1,222 @@
+"""
+Shared pytest fixtures.
+"""
+import hashlib
+import io
+import mmap
+import os
+from pathlib import Path
+import sys
+from typing import BinaryIO, Callable, Dict, List
+import zipfile
+
+import pytest
+
+# --- Make sure the project root is on sys.path ---
+ROOT_DIR = Path(__file__).resolve().parents[1]  # one directory back
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+from app.rag import _read_pdf, _read_docx, _read_excel, _read_csv
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+# Fixture key -> path. The samples are keyed by extension.
+FIXTURES: Dict[str, Path] = {
+    "pdf": FIXTURES_DIR / "sample.pdf",
+    "docx": FIXTURES_DIR / "sample.docx",
+    "xlsx": FIXTURES_DIR / "sample.xlsx",
+    "csv": FIXTURES_DIR / "sample.csv",
+    "md": FIXTURES_DIR / "sample.md",
+    "corrupt": FIXTURES_DIR / "corrupt.docx",
+    "empty": FIXTURES_DIR / "empty.pdf",
+}
+
+READERS: Dict[str, Callable[[BinaryIO], str]] = {
+    ".pdf": _read_pdf,
+    ".docx": _read_docx,
+    ".xlsx": _read_excel,
+    ".csv": _read_csv,
+}
+
+# --- Fixture synthesis --------------------------------------------------------
+# Used only when a fixture file is missing (e.g. a sparse checkout), so the
+# suite never has to probe for files and skip.
+
+SAMPLE_LINES: List[str] = [
+    "Experience: Embedded Software Engineer",
+    "Skills: C/C++, Python, Zephyr RTOS, CAN/LIN",
+    "Achievement: Led HIL automation reducing test time by 32%",
+]
+
+
+def _pdf_bytes(lines: List[str]) -> bytes:
+    """A one-page PDF showing `lines` in Helvetica."""
+    esc = lambda s: s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    stream = "BT /F1 12 Tf 14 TL 72 720 Td " + " ".join(f"({esc(l)}) '" for l in lines) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        "/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(out)
+
+
+def _write_docx(path: Path, lines: List[str]) -> None:
+    """A minimal WordprocessingML package with one paragraph per line."""
+    ns = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    paras = "".join(f"<w:p><w:r><w:t>{l}</w:t></w:r></w:p>" for l in lines)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType='
+            '"application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ))
+        z.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="word/document.xml"/>'
+            '</Relationships>'
+        ))
+        z.writestr("word/document.xml", (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<w:document xmlns:w="{ns}"><w:body>{paras}</w:body></w:document>'
+        ))
+
+
+def _write_xlsx(path: Path) -> None:
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Projects"
+    for row in [("Project", "Technology", "Impact"),
+                ("HIL Automation", "Python CANoe", "32% time reduction")]:
+        ws.append(row)
+    ws = wb.create_sheet("Skills")
+    for row in [("Skill", "Level"), ("C/C++", "Expert"), ("Python", "Advanced")]:
+        ws.append(row)
+    wb.save(path)
+
+
+def _write_fixture(key: str, path: Path) -> None:
+    if key == "pdf":
+        path.write_bytes(_pdf_bytes(["Sample PDF Document", *SAMPLE_LINES]))
+    elif key == "docx":
+        _write_docx(path, ["Sample DOCX Document", *SAMPLE_LINES])
+    elif key == "xlsx":
+        _write_xlsx(path)
+    elif key == "csv":
+        path.write_text(
+            "name,position,years_experience,skills\n"
+            "Jane Smith,Embedded Engineer,7,C Zephyr CAN\n"
+        )
+    elif key == "md":
+        path.write_text(
+            "---\ntype: application\ncompany: TestCorp\ntitle: Senior Engineer\n"
+            "date: 2025-11-10\n---\n\n# My Application\n\n" + "\n".join(SAMPLE_LINES) + "\n"
+        )
+    elif key == "corrupt":
+        path.write_text("This is not a valid DOCX file")
+    elif key == "empty":
+        path.write_bytes(b"")
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers",
+        "needs_fixture(*keys): the test reads these FIXTURES entries and is "
+        "skipped if any of their files is absent",
+    )
+
+
+def pytest_sessionstart(session):
+    """Create any missing fixture file once, before collection. Each file is
+    written under a temporary name and renamed into place, so xdist workers
+    starting together never see a half-written fixture. A file that cannot
+    be written (read-only checkout) is left for collection to skip."""
+    try:
+        FIXTURES_DIR.mkdir(exist_ok=True)
+    except OSError:
+        return
+    for key, path in FIXTURES.items():
+        if path.exists():
+            continue
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            _write_fixture(key, tmp)
+            os.replace(tmp, path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skip tests whose `needs_fixture` files are absent, from a single
+    directory scan rather than a stat() per test."""
+    try:
+        with os.scandir(FIXTURES_DIR) as entries:
+            present = {e.name for e in entries if e.is_file()}
+    except FileNotFoundError:
+        present = set()
+    for item in items:
+        missing = sorted({
+            FIXTURES[key].name
+            for mark in item.iter_markers("needs_fixture")
+            for key in mark.args
+            if FIXTURES[key].name not in present
+        })
+        if missing:
+            item.add_marker(pytest.mark.skip(reason=f"fixture not found: {', '.join(missing)}"))
+
+
+def _mmap_open(path: Path) -> io.BytesIO:
+    """The file's bytes as a BytesIO filled straight from a read-only mmap,
+    without a buffered read() through the file object."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return io.BytesIO()  # mmap rejects empty files
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return io.BytesIO(view)
+
+
+class ParsedFixtures:
+    """Extracted text of the sample fixtures, parsed at most once per
+    session. Texts are memoized by a BLAKE2b fingerprint of the file bytes,
+    so an edited fixture is parsed again rather than served stale."""
+
+    def __init__(self, fixtures: Dict[str, Path]):
+        self.fixtures = fixtures
+        self._texts: Dict[str, str] = {}
+
+    def __getitem__(self, key: str) -> str:
+        path = self.fixtures[key]
+        data = _mmap_open(path)
+        digest = hashlib.blake2b(data.getbuffer()).hexdigest()
+        if digest not in self._texts:
+            self._texts[digest] = READERS[path.suffix.lower()](data)
+        return self._texts[digest]
+
+
+@pytest.fixture(scope="session")
+def parsed_fixtures() -> ParsedFixtures:
+    """Fixture key -> extracted text, for tests that only check content.
+    Tests of a reader's error path should call the reader directly."""
+    return ParsedFixtures(FIXTURES)
@@ -0,0 +1,830 @@
+"""
+Unit tests for the RAG helpers (embeddings, retrieval, generation).
+
+Ollama and Chroma are always mocked; nothing here needs a running server.
+"""
+import json
+import pytest
+from pathlib import Path
+from unittest.mock import call, patch, MagicMock
+import sys
+
+import numpy as np
+
+# --- Make sure the project root is on sys.path ---
+ROOT_DIR = Path(__file__).resolve().parents[1]  # one directory back
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import app.rag as rag
+from app.rag import embed_texts
+from app.embed_cache import EmbedCache, content_key, quantize, dequantize
+from app.query_cache import QueryCache
+from app.matrix_index import MatrixIndex
+from app.vector_index import VectorIndex
+
+
+@pytest.fixture(autouse=True)
+def _no_disk_cache(monkeypatch, tmp_path):
+    """Keep tests off the real on-disk caches."""
+    monkeypatch.setattr(rag, "_get_embed_cache", lambda: None)
+    monkeypatch.setattr(rag, "_neighbor_table", None)
+    monkeypatch.setattr(rag, "NEIGHBOR_TABLE_PATH", str(tmp_path / "neighbors.sqlite3"))
+    monkeypatch.setattr(rag, "CORPUS_STAMP_PATH", str(tmp_path / "corpus.stamp"))
+    monkeypatch.setattr(rag, "_query_cache", QueryCache())
+    monkeypatch.setattr(rag, "MATRIX_SEARCH_MAX_N", 0)
+    monkeypatch.setattr(rag, "_matrix_index", None)
+    monkeypatch.setattr(rag, "_vector_index", None)
+    monkeypatch.setattr(rag, "_local_count", -1)
+    monkeypatch.setattr(rag, "_local_stamp", "")
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+def _vec(text):
+    return [float(len(text)), 1.0]
+
+
+def _unit(rows):
+    rows = np.asarray(rows, dtype=np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def _fake_embed_endpoint(sent):
+    def post(url, json):
+        assert url == "/api/embed"
+        sent.append(list(json["input"]))
+        return FakeResponse(200, {"embeddings": [_vec(t) for t in json["input"]]})
+    return post
+
+
+@pytest.fixture(autouse=True)
+def _batch_endpoint(monkeypatch):
+    monkeypatch.setattr(rag, "_batch_endpoint", True)
+
+
+class TestEmbedTexts:
+    """Test batching in embed_texts."""
+
+    def test_batched_endpoint_called_once_per_batch(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(rag._http, "post", _fake_embed_endpoint(calls))
+        texts = [f"chunk {i}" * (i + 1) for i in range(5)]
+
+        out = embed_texts(texts, batch_size=2)
+        assert [len(c) for c in calls] == [2, 2, 1]
+        assert out.dtype == np.float32 and out.shape == (5, 2)
+        np.testing.assert_allclose(out, _unit([_vec(t) for t in texts]), rtol=1e-6)
+
+    def test_falls_back_to_per_text_calls_in_order(self, monkeypatch):
+        post = MagicMock(return_value=FakeResponse(404, {}))
+        monkeypatch.setattr(rag._http, "post", post)
+        fake = MagicMock(side_effect=lambda model, prompt: {"embedding": _vec(prompt)})
+        monkeypatch.setattr(rag._ollama, "embeddings", fake)
+        texts = ["a", "bb", "ccc"]
+
+        np.testing.assert_allclose(embed_texts(texts), _unit([_vec(t) for t in texts]), rtol=1e-6)
+        embed_texts(["dddd"])
+        assert fake.call_count == 4
+        post.assert_called_once()  # the missing endpoint is not retried
+
+    def test_bad_response_raises(self, monkeypatch):
+        monkeypatch.setattr(rag._http, "post", lambda url, json: FakeResponse(200, {}))
+        with pytest.raises(RuntimeError, match="Embedding failed"):
+            embed_texts(["x"])
+
+    def test_model_error_is_not_mistaken_for_old_server(self, monkeypatch):
+        resp = FakeResponse(404, {"error": "model 'nomic-embed-text' not found"})
+        monkeypatch.setattr(rag._http, "post", lambda url, json: resp)
+        with pytest.raises(RuntimeError, match="not found"):
+            embed_texts(["x"])
+        assert rag._batch_endpoint is True
+
+
+class TestSentenceTransformersBackend:
+    """Test the in-process EMBED_BACKEND=st path."""
+
+    def test_encodes_in_process(self, monkeypatch):
+        model = MagicMock()
+        model.encode.side_effect = lambda texts, **kw: np.ones((len(texts), 3))
+        monkeypatch.setattr(rag, "EMBED_BACKEND", "st")
+        monkeypatch.setattr(rag, "_get_st_model", lambda: model)
+        monkeypatch.setattr(rag._http, "post", MagicMock(side_effect=AssertionError("no HTTP")))
+
+        out = embed_texts(["a", "b"], batch_size=16)
+        assert out.shape == (2, 3) and out.dtype == np.float32
+        assert model.encode.call_args.kwargs["normalize_embeddings"] is True
+        assert model.encode.call_args.kwargs["batch_size"] == 16
+
+    def test_cache_key_differs_from_ollama(self, monkeypatch):
+        ollama_id = rag._cache_model_id()
+        monkeypatch.setattr(rag, "EMBED_BACKEND", "st")
+        assert rag._cache_model_id() != ollama_id
+
+    def test_missing_package_is_reported(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, "sentence_transformers", None)
+        rag._get_st_model.cache_clear()
+        with pytest.raises(RuntimeError, match="sentence-transformers"):
+            rag._get_st_model()
+        rag._get_st_model.cache_clear()
+
+
+class TestEmbedCache:
+    """Test the content-hash embedding cache."""
+
+    def test_roundtrip_and_insert_or_ignore(self, tmp_path):
+        cache = EmbedCache(str(tmp_path / "emb.sqlite3"))
+        k1, k2 = content_key("m", "hello"), content_key("m", "world")
+        cache.put_many([(k1, np.array([0.5, 1.5]))])
+        cache.put_many([(k1, np.array([9.0, 9.0]))])
+
+        found = cache.get_many([k1, k2])
+        assert list(found) == [k1]
+        np.testing.assert_allclose(found[k1], [0.5, 1.5], atol=1.5 / 127)
+
+    def test_int8_quantization_error_is_small(self):
+        v = np.random.default_rng(0).normal(size=768).astype(np.float32)
+        scale, data = quantize(v)
+        assert len(data) == 768
+        restored = dequantize(scale, data)
+        cos = restored @ v / (np.linalg.norm(restored) * np.linalg.norm(v))
+        assert cos > 0.999
+
+    @pytest.mark.parametrize("dtype,nbytes", [("float16", 2), ("float32", 4)])
+    def test_plain_dtypes(self, tmp_path, dtype, nbytes):
+        cache = EmbedCache(str(tmp_path / "emb.sqlite3"), dtype=dtype)
+        v = np.random.default_rng(1).normal(size=64).astype(np.float32)
+        cache.put_many([(b"k", v)])
+        (restored,) = cache.get_many([b"k"]).values()
+        assert restored.dtype == np.float32
+        np.testing.assert_allclose(restored, v, rtol=1e-3 if nbytes == 2 else 0)
+        blob = cache._conn.execute(f"SELECT vec FROM {cache._table}").fetchone()[0]
+        assert len(blob) == 64 * nbytes
+
+    def test_unknown_dtype_rejected(self, tmp_path):
+        with pytest.raises(ValueError, match="dtype"):
+            EmbedCache(str(tmp_path / "emb.sqlite3"), dtype="bf16")
+
+    def test_key_depends_on_model(self):
+        assert content_key("a", "text") != content_key("b", "text")
+
+    def test_embed_texts_only_sends_misses(self, tmp_path, monkeypatch):
+        cache = EmbedCache(str(tmp_path / "emb.sqlite3"))
+        monkeypatch.setattr(rag, "_get_embed_cache", lambda: cache)
+        sent = []
+        monkeypatch.setattr(rag._http, "post", _fake_embed_endpoint(sent))
+
+        np.testing.assert_allclose(embed_texts(["a", "bb"]), _unit([_vec("a"), _vec("bb")]), rtol=1e-6)
+        np.testing.assert_allclose(
+            embed_texts(["bb", "ccc", "a"]),
+            _unit([_vec("bb"), _vec("ccc"), _vec("a")]),
+            atol=0.01,
+        )
+        assert sent == [["a", "bb"], ["ccc"]]
+
+    def test_repeated_texts_sent_once(self, monkeypatch):
+        sent = []
+        monkeypatch.setattr(rag._http, "post", _fake_embed_endpoint(sent))
+
+        out = embed_texts(["a", "bb", "a", "a"])
+        assert sent == [["a", "bb"]]
+        np.testing.assert_allclose(out, _unit([_vec(t) for t in ["a", "bb", "a", "a"]]), rtol=1e-6)
+
+
+class TestChunking:
+    """Test streaming chunking and batched ingestion."""
+
+    def test_chunk_stream_matches_chunk_on_joined_text(self):
+        pages = ["  first page " + "a" * 1200, "b" * 50, "c" * 2000 + "  \n"]
+        joined = "\n".join(pages).strip()
+        assert list(rag._chunk_stream(pages)) == rag._chunk(joined)
+        assert list(rag._chunk_stream(pages, chunk=100, overlap=0)) == rag._chunk(joined, 100, 0)
+
+    def test_chunk_windows_and_trailing_blanks(self):
+        text = "x" * 1000 + " " * 1500
+        assert rag._chunk(text) == [text[0:900], text[750:1650]]
+        assert rag._chunk("") == []
+        assert rag._chunk("abcdef", chunk=4, overlap=2) == ["abcd", "cdef", "ef"]
+
+    def test_chunk_iter_is_lazy(self):
+        it = rag._chunk_iter("x" * 10_000, chunk=100, overlap=0)
+        assert next(it) == "x" * 100
+        assert sum(1 for _ in it) == 99
+
+    def test_chunk_stream_skips_leading_blank_pages(self):
+        assert list(rag._chunk_stream(["   ", "", "text"])) == ["text"]
+
+    def test_chunk_stream_matches_chunk_on_random_pages(self):
+        import random
+        rng = random.Random(0)
+        for _ in range(500):
+            pages = ["".join(rng.choice("ab \n") for _ in range(rng.randrange(40)))
+                     for _ in range(rng.randrange(1, 6))]
+            pages.append(" " * rng.randrange(1, 20))  # whitespace-only last page
+            chunk = rng.randrange(1, 12)
+            overlap = rng.randrange(chunk)
+            joined = "\n".join(pages).strip()
+            assert list(rag._chunk_stream(pages, chunk, overlap)) == rag._chunk(joined, chunk, overlap), pages
+
+    def test_token_chunks_follow_token_offsets(self, monkeypatch):
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        words = [f"w{i}" for i in range(10)]
+        tok = Tokenizer(models.WordLevel({w: i for i, w in enumerate(words)}, unk_token="w0"))
+        tok.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        monkeypatch.setattr(rag, "_get_tokenizer", lambda: tok)
+
+        text = " ".join(words)
+        assert rag._chunk_tokens(text, chunk=4, overlap=1) == [
+            "w0 w1 w2 w3", "w3 w4 w5 w6", "w6 w7 w8 w9",
+        ]
+        assert rag._chunk_tokens("w1 w2", chunk=4, overlap=1) == ["w1 w2"]
+        assert rag._chunk_tokens("", chunk=4, overlap=1) == []
+
+    def test_coerce_meta_scalars_and_containers(self):
+        import datetime
+        meta = {"a": "x", "n": 1, "f": 1.5, "b": True, "none": None,
+                "tags": ["c", "é"], "d": datetime.date(2025, 1, 2),
+                "yaml": {2025: [datetime.date(2025, 3, 4)]}}
+        fixed = rag._coerce_meta(meta)
+        assert fixed["tags"] == '["c","é"]'
+        assert fixed["d"] == "2025-01-02"
+        assert fixed["yaml"] == '{"2025":["2025-03-04"]}'
+        assert rag._coerce_meta(fixed) == fixed
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_ingest_stream_upserts_in_batches(self, mock_embed, mock_chroma, monkeypatch):
+        monkeypatch.setattr(rag, "INGEST_BATCH", 4)
+        mock_collection = MagicMock()
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: [[0.1] * 8 for _ in texts]
+
+        result = rag.ingest_stream((f"chunk {i}" for i in range(10)), {"doc_id": "d"})
+        assert result == {"added": 10}
+        batches = [c.kwargs["ids"] for c in mock_collection.upsert.call_args_list]
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert batches[-1] == ["d-8", "d-9"]
+        metas = mock_collection.upsert.call_args.kwargs["metadatas"]
+        assert metas[0] is metas[1]  # one shared dict, not per-chunk copies
+
+    @patch("app.rag._on_corpus_changed")
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_failed_stream_removes_partial_document(self, mock_embed, mock_chroma, mock_changed, monkeypatch):
+        monkeypatch.setattr(rag, "INGEST_BATCH", 2)
+        mock_collection = MagicMock()
+        mock_collection.get.return_value = {"ids": ["d-0", "d-1", "d-7"]}
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: [[0.1] * 8 for _ in texts]
+
+        def pages():
+            yield from ["p0", "p1", "p2"]
+            raise ValueError("Failed to read PDF big.pdf: bad page")
+
+        with pytest.raises(ValueError, match="bad page"):
+            rag.ingest_stream(pages(), {"doc_id": "d"})
+        assert mock_collection.upsert.call_count == 1  # the first full batch
+        mock_collection.get.assert_called_once_with(where={"doc_id": "d"}, include=[])
+        assert sorted(mock_collection.delete.call_args.kwargs["ids"]) == ["d-0", "d-1", "d-7"]
+        mock_changed.assert_called_once()
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_id_prefix_falls_back_past_empty_doc_id(self, mock_embed, mock_chroma):
+        mock_collection = MagicMock()
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: [[0.1] * 8 for _ in texts]
+
+        rag.ingest_stream(["a", "b"], {"doc_id": "", "title": "Post"})
+        assert mock_collection.upsert.call_args.kwargs["ids"] == ["Post-0", "Post-1"]
+
+    @patch("app.rag._on_corpus_changed")
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_batch_buffer_writes_across_documents(self, mock_embed, mock_chroma, mock_changed, monkeypatch):
+        monkeypatch.setattr(rag, "INGEST_BATCH", 4)
+        mock_collection = MagicMock()
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: np.full((len(texts), 8), 0.1, dtype=np.float32)
+        buffer = rag.BatchBuffer(flush_at=8)
+
+        rag.ingest_stream((f"a{i}" for i in range(5)), {"doc_id": "a"}, buffer)
+        rag.ingest_stream((f"b{i}" for i in range(5)), {"doc_id": "b"}, buffer)
+        assert mock_collection.upsert.call_count == 1
+        first = mock_collection.upsert.call_args.kwargs
+        assert first["ids"] == [f"a-{i}" for i in range(5)] + ["b-0", "b-1", "b-2", "b-3"]
+        assert first["embeddings"].shape == (9, 8)
+
+        buffer.flush()
+        assert mock_collection.upsert.call_args.kwargs["ids"] == ["b-4"]
+        assert len(buffer) == 0
+        assert mock_changed.call_count == 2
+
+    @patch("app.rag._on_corpus_changed")
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_batch_buffer_keeps_one_source_per_doc_id(self, mock_embed, mock_chroma, mock_changed):
+        mock_collection = MagicMock()
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: np.full((len(texts), 8), 0.1, dtype=np.float32)
+        buffer = rag.BatchBuffer(flush_at=100)
+
+        # cv.pdf and cv.docx both get doc_id "cv"
+        rag.ingest_stream(["pdf text"], {"doc_id": "cv"}, buffer, source="cv.pdf")
+        rag.ingest_stream(["docx text"], {"doc_id": "cv"}, buffer, source="cv.docx")
+        rag.ingest_stream(["csv text"], {"doc_id": "notes"}, buffer, source="notes.csv")
+        buffer.flush()
+
+        batches = [c.kwargs["ids"] for c in mock_collection.upsert.call_args_list]
+        assert batches == [["cv-0", "notes-0"]]
+        assert mock_collection.upsert.call_args.kwargs["documents"] == ["docx text", "csv text"]
+        assert buffer.superseded == {"cv.pdf": "cv.docx"}
+        assert buffer.failed == {}
+
+    @patch("app.rag._on_corpus_changed")
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_batch_buffer_shared_doc_id_follows_order_not_arrival(self, mock_embed, mock_chroma, mock_changed):
+        mock_collection = MagicMock()
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: np.full((len(texts), 8), 0.1, dtype=np.float32)
+        buffer = rag.BatchBuffer(flush_at=100, order={"cv.pdf": 0, "cv.docx": 1})
+
+        # A worker thread finishing cv.docx first must not let cv.pdf win
+        rag.ingest_stream(["docx text"], {"doc_id": "cv"}, buffer, source="cv.docx")
+        rag.ingest_stream(["pdf 0", "pdf 1"], {"doc_id": "cv"}, buffer, source="cv.pdf")
+        buffer.flush()
+
+        assert mock_collection.upsert.call_args.kwargs["documents"] == ["docx text"]
+        assert buffer.superseded == {"cv.pdf": "cv.docx"}
+
+    @patch("app.rag._on_corpus_changed")
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_batch_buffer_records_failed_write_per_source(self, mock_embed, mock_chroma, mock_changed):
+        mock_collection = MagicMock()
+        mock_collection.upsert.side_effect = [RuntimeError("disk full"), None]
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.side_effect = lambda texts: np.full((len(texts), 8), 0.1, dtype=np.float32)
+        buffer = rag.BatchBuffer(flush_at=3)
+
+        rag.ingest_stream(["a0", "a1"], {"doc_id": "a"}, buffer, source="a.md")
+        rag.ingest_stream(["b0"], {"doc_id": "b"}, buffer, source="b.md")  # fails
+        rag.ingest_stream(["c0"], {"doc_id": "c"}, buffer, source="c.md")
+        buffer.flush()
+
+        assert set(buffer.failed) == {"a.md", "b.md"}
+        assert str(buffer.failed["b.md"]) == "disk full"
+        # The failed rows were dropped, not retried with the next file
+        assert mock_collection.upsert.call_args.kwargs["ids"] == ["c-0"]
+        assert len(buffer) == 0
+        assert mock_changed.call_count == 1
+
+
+class TestMarkdownCache:
+    """Test the front-matter parse cache used by ingest_file."""
+
+    @patch("app.rag.ingest_text")
+    def test_unchanged_file_is_parsed_once(self, mock_ingest, tmp_path, monkeypatch):
+        rag._load_markdown.cache_clear()
+        real_loads = rag.frontmatter.loads
+        loads = MagicMock(side_effect=real_loads)
+        monkeypatch.setattr(rag.frontmatter, "loads", loads)
+        md = tmp_path / "post.md"
+        md.write_text("---\ncompany: A\n---\nBody one\n", encoding="utf-8")
+
+        rag.ingest_file(str(md))
+        rag.ingest_file(str(md))
+        assert loads.call_count == 1
+
+        md.write_text("---\ncompany: B\n---\nBody two, longer\n", encoding="utf-8")
+        rag.ingest_file(str(md))
+        assert loads.call_count == 2
+        text, meta = mock_ingest.call_args.args
+        assert text.strip() == "Body two, longer" and meta["company"] == "B"
+
+
+class TestReadExcel:
+    """Test the optional python-calamine spreadsheet path."""
+
+    def test_calamine_output_matches_openpyxl(self, monkeypatch):
+        from openpyxl import load_workbook
+        xlsx = ROOT_DIR / "tests" / "fixtures" / "sample.xlsx"
+        monkeypatch.setattr(rag, "CalamineWorkbook", None)
+        expected = rag._read_excel(xlsx)
+
+        wb = load_workbook(xlsx, read_only=True, data_only=True)
+        sheets = {ws.title: list(ws.iter_rows(values_only=True)) for ws in wb.worksheets}
+        wb.close()
+        fake_wb = MagicMock(sheet_names=list(sheets))
+        fake_wb.get_sheet_by_name.side_effect = lambda name: MagicMock(
+            iter_rows=lambda: iter(sheets[name])
+        )
+        fake_cls = MagicMock()
+        fake_cls.from_path.return_value = fake_wb
+        monkeypatch.setattr(rag, "CalamineWorkbook", fake_cls)
+
+        assert rag._read_excel(xlsx) == expected
+        assert rag._read_excel(str(xlsx)) == expected  # a str path, not a file object
+        assert fake_cls.from_path.call_args_list == [call(str(xlsx))] * 2
+        fake_cls.from_filelike.assert_not_called()
+
+    @pytest.mark.parametrize("calamine", [False, True])
+    def test_path_str_and_stream_read_alike(self, calamine, monkeypatch):
+        xlsx = ROOT_DIR / "tests" / "fixtures" / "sample.xlsx"
+        if calamine:
+            monkeypatch.setattr(rag, "CalamineWorkbook",
+                                pytest.importorskip("python_calamine").CalamineWorkbook)
+        else:
+            monkeypatch.setattr(rag, "CalamineWorkbook", None)
+
+        text = rag._read_excel(xlsx)
+        assert "# Sheet: Projects" in text and "HIL Automation" in text
+        assert rag._read_excel(str(xlsx)) == text
+        with open(xlsx, "rb") as f:
+            assert rag._read_excel(f) == text
+
+
+class TestReadText:
+    """Test the mmap-backed text reader."""
+
+    def test_matches_read_text(self, tmp_path):
+        f = tmp_path / "notes.txt"
+        f.write_bytes("héllo\r\nwörld\rend\n".encode("utf-8"))
+        assert rag._read_text(f) == f.read_text(encoding="utf-8") == "héllo\nwörld\nend\n"
+
+    def test_empty_file(self, tmp_path):
+        f = tmp_path / "empty.txt"
+        f.write_bytes(b"")
+        assert rag._read_text(f) == ""
+
+    def test_invalid_utf8(self, tmp_path):
+        f = tmp_path / "bad.txt"
+        f.write_bytes(b"ok\xff")
+        assert rag._read_text(f, errors="ignore") == "ok"
+        with pytest.raises(UnicodeDecodeError):
+            rag._read_text(f)
+
+
+class TestParseFile:
+    """Test parse_file, the side-effect-free half of ingest_file."""
+
+    @patch("app.rag._init_chroma", side_effect=AssertionError("no Chroma"))
+    @patch("app.rag.embed_texts", side_effect=AssertionError("no Ollama"))
+    def test_returns_text_and_metadata(self, _embed, _chroma):
+        fixtures = ROOT_DIR / "tests" / "fixtures"
+        text, meta = rag.parse_file(str(fixtures / "sample.csv"))
+        assert text and meta == {
+            "filename": "sample.csv", "type": "file", "doc_id": "sample", "source_ext": "csv",
+        }
+        text, meta = rag.parse_file(str(fixtures / "sample.md"))
+        assert meta["type"] != "file" and meta["doc_id"] == "sample"
+
+
+class TestExtractJson:
+    """Test JSON recovery from model output."""
+
+    @pytest.mark.parametrize("text", [
+        '{"a": 1}',
+        '```json\n{"a": 1}\n```',
+        'Sure! Here it is: {"a": 1} Hope this helps {not json}',
+        '{broken {"a": 1}',
+    ])
+    def test_recovers_object(self, text):
+        assert rag._extract_json(text) == {"a": 1}
+
+    def test_returns_none_without_json(self):
+        assert rag._extract_json("no braces here {") is None
+
+
+class TestSearch:
+    """Test retrieval through a mocked Chroma collection."""
+
+    @pytest.fixture(autouse=True)
+    def _clear_query_cache(self):
+        rag._embed_query.cache_clear()
+        yield
+        rag._embed_query.cache_clear()
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_repeated_query_embeds_once(self, mock_embed, mock_chroma):
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = {
+            "ids": [["d-0"]], "documents": [["text"]],
+            "metadatas": [[{"doc_id": "d"}]], "distances": [[0.1]],
+        }
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.return_value = [[0.1] * 768]
+
+        first = rag.search("same job post")
+        second = rag.search("same job post")
+        assert first == second
+        assert first[0]["id"] == "d-0"
+        mock_embed.assert_called_once()
+        mock_collection.query.assert_called_once()  # second served by the query cache
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_precomputed_query_skips_hnsw(self, mock_embed, mock_chroma):
+        mock_collection = MagicMock()
+        mock_collection.query.return_value = {
+            "ids": [["d-1", "d-0"]], "documents": [["one", "zero"]],
+            "metadatas": [[{}, {}]], "distances": [[0.1, 0.2]],
+        }
+        # Chroma's get() does not preserve the requested order
+        mock_collection.get.return_value = {
+            "ids": ["d-0", "d-1"], "documents": ["zero", "one"], "metadatas": [{}, {}],
+        }
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+        mock_embed.return_value = [[0.1] * 768]
+
+        rag.precompute_neighbors(["Hot  Query"], k=2)
+        hits = rag.search("hot query", k=2)
+        assert [(h["id"], h["text"], h["distance"]) for h in hits] == [
+            ("d-1", "one", 0.1), ("d-0", "zero", 0.2),
+        ]
+        assert mock_collection.query.call_count == 1
+
+        # A larger k than was precomputed goes back to Chroma
+        rag.search("hot query", k=5)
+        assert mock_collection.query.call_count == 2
+
+
+class TestMatrixIndex:
+    """Test exact in-memory retrieval for small corpora."""
+
+    def test_top_k_matches_brute_force(self):
+        rng = np.random.default_rng(2)
+        emb = rng.normal(size=(50, 16)).astype(np.float32)
+        ids = [f"d-{i}" for i in range(50)]
+        index = MatrixIndex(ids, [f"t{i}" for i in range(50)], [{}] * 50, emb)
+        q = rng.normal(size=16)
+
+        unit = emb / np.linalg.norm(emb, axis=1, keepdims=True)
+        dist = ((unit - q / np.linalg.norm(q)) ** 2).sum(axis=1)
+        expected = [ids[i] for i in np.argsort(dist)[:5]]
+        hits = index.search(q, 5)
+        assert [h["id"] for h in hits] == expected
+        np.testing.assert_allclose([h["distance"] for h in hits], np.sort(dist)[:5], rtol=1e-4)
+
+    def test_small_and_empty(self):
+        index = MatrixIndex(["a", "b"], ["A", "B"], [{}, {}], [[1.0, 0.0], [0.0, 1.0]])
+        assert [h["id"] for h in index.search(np.array([0.1, 1.0]), 8)] == ["b", "a"]
+        assert MatrixIndex([], [], [], []).search(np.array([1.0]), 3) == []
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_search_uses_matrix_and_rebuilds_on_size_change(self, mock_embed, mock_chroma, monkeypatch):
+        monkeypatch.setattr(rag, "MATRIX_SEARCH_MAX_N", 100)
+        rag._embed_query.cache_clear()
+        mock_embed.side_effect = lambda texts: [[1.0, 0.0] for _ in texts]
+        mock_collection = MagicMock()
+        mock_collection.count.return_value = 2
+        mock_collection.get.return_value = {
+            "ids": ["d-0", "d-1"], "documents": ["far", "near"],
+            "metadatas": [{}, {}], "embeddings": [[0.0, 1.0], [1.0, 0.1]],
+        }
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+
+        assert [h["id"] for h in rag.search("job", k=1)] == ["d-1"]
+        rag.search("job", k=1)
+        mock_collection.query.assert_not_called()
+        assert mock_collection.get.call_count == 1
+
+        mock_collection.count.return_value = 3  # e.g. bulk_ingest in another process
+        rag.search("job", k=1)
+        assert mock_collection.get.call_count == 2
+        rag._embed_query.cache_clear()
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_search_rebuilds_after_same_size_change_elsewhere(self, mock_embed, mock_chroma, monkeypatch):
+        monkeypatch.setattr(rag, "MATRIX_SEARCH_MAX_N", 100)
+        rag._embed_query.cache_clear()
+        mock_embed.side_effect = lambda texts: [[1.0, 0.0] for _ in texts]
+        mock_collection = MagicMock()
+        mock_collection.count.return_value = 2
+        mock_collection.get.side_effect = [
+            {"ids": ["d-0", "d-1"], "documents": ["old", "older"],
+             "metadatas": [{}, {}], "embeddings": [[1.0, 0.0], [0.0, 1.0]]},
+            {"ids": ["d-0", "d-1"], "documents": ["new", "newer"],
+             "metadatas": [{}, {}], "embeddings": [[1.0, 0.0], [0.0, 1.0]]},
+        ]
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+
+        assert rag.search("job", k=1)[0]["text"] == "old"
+        # Another process re-ingests "d" at the same chunk count
+        with open(rag.CORPUS_STAMP_PATH, "w") as f:
+            f.write("other-process")
+        assert rag.search("job", k=1)[0]["text"] == "new"
+        assert mock_collection.get.call_count == 2
+        rag._embed_query.cache_clear()
+
+
+class TestVectorIndex:
+    """Test the hnswlib index used above MATRIX_SEARCH_MAX_N."""
+
+    def test_nearest_and_replace(self):
+        rng = np.random.default_rng(3)
+        emb = rng.normal(size=(40, 8)).astype(np.float32)
+        index = VectorIndex(8, capacity=4)  # grows past its initial capacity
+        index.add([f"d-{i}" for i in range(40)], emb)
+        assert len(index) == 40
+        (hit_id, dist), = index.search(emb[7], 1)
+        assert hit_id == "d-7" and dist == pytest.approx(0.0, abs=1e-5)
+
+        index.add(["d-7"], -emb[7:8])  # upsert: the old vector no longer matches
+        assert len(index) == 40
+        assert index.search(emb[7], 1)[0][0] != "d-7"
+        assert index.search(-emb[7], 1)[0][0] == "d-7"
+        assert len(index.search(emb[0], 100)) == 40
+
+        index.remove(["d-7", "missing"])
+        assert len(index) == 39
+        assert "d-7" not in [i for i, _ in index.search(-emb[7], 39)]
+
+    @patch("app.rag._init_chroma")
+    @patch("app.rag.embed_texts")
+    def test_large_corpus_searches_and_mirrors_writes(self, mock_embed, mock_chroma, monkeypatch):
+        monkeypatch.setattr(rag, "MATRIX_SEARCH_MAX_N", 1)
+        rag._embed_query.cache_clear()
+        mock_embed.side_effect = lambda texts: np.array([[1.0, 0.0] for _ in texts])
+        mock_collection = MagicMock()
+        mock_collection.count.return_value = 2
+        mock_collection.get.side_effect = [
+            {"ids": ["d-0", "d-1"], "embeddings": [[0.0, 1.0], [1.0, 0.1]]},
+            {"ids": []},
+            {"ids": ["d-1"], "documents": ["near"], "metadatas": [{}]},
+        ]
+        mock_chroma.return_value = (MagicMock(), mock_collection)
+
+        hits = rag.search("job", k=1)
+        assert [(h["id"], h["text"]) for h in hits] == [("d-1", "near")]
+        mock_collection.query.assert_not_called()
+
+        mock_collection.count.return_value = 3
+        rag._write_chunks(mock_collection, ["d-2"], ["new"], np.array([[1.0, 0.0]]), [{}])
+        assert len(rag._vector_index) == 3 and rag._local_count == 3
+        rag._embed_query.cache_clear()
+
+
+class TestQueryCache:
+    """Test the in-memory semantic query cache."""
+
+    def test_near_duplicate_query_reuses_hits(self):
+        cache = QueryCache(capacity=4, min_sim=0.95)
+        hits = [{"id": "a"}, {"id": "b"}]
+        cache.put(np.array([1.0, 0.0]), 2, hits)
+
+        assert cache.get(np.array([0.99, 0.05]), 2) == hits
+        assert cache.get(np.array([0.99, 0.05]), 1) == hits[:1]
+        assert cache.get(np.array([0.0, 1.0]), 2) is None  # dissimilar
+        assert cache.get(np.array([1.0, 0.0]), 3) is None  # more hits than stored
+
+    def test_evicts_least_recently_used(self):
+        cache = QueryCache(capacity=2, min_sim=0.99)
+        a, b, c = np.eye(3)
+        cache.put(a, 1, [{"id": "a"}])
+        cache.put(b, 1, [{"id": "b"}])
+        cache.get(a, 1)
+        cache.put(c, 1, [{"id": "c"}])
+
+        assert len(cache) == 2
+        assert cache.get(b, 1) is None
+        assert cache.get(a, 1) == [{"id": "a"}]
+
+    @patch("app.rag._reset_response_cache")
+    def test_cleared_when_corpus_changes(self, _reset):
+        rag._query_cache.put(np.array([1.0, 0.0]), 1, [{"id": "a"}])
+        rag._on_corpus_changed()
+        assert len(rag._query_cache) == 0
+
+
+class TestSelectContext:
+    """Test context dedup and token budgeting."""
+
+    @staticmethod
+    def _hits(*texts):
+        return [{"id": f"d-{i}", "text": t} for i, t in enumerate(texts)]
+
+    def test_drops_near_duplicates(self):
+        base = "Led HIL automation reducing ECU test time by 32 percent. " * 5
+        hits = self._hits(base, base.replace("32", "33"), "Completely different text about Zephyr.")
+        assert [h["id"] for h in rag._select_context(hits)] == ["d-0", "d-2"]
+
+    def test_respects_token_budget(self, monkeypatch):
+        monkeypatch.setattr(rag, "MAX_CTX_TOKENS", 30)
+        hits = self._hits("a" * 80, "b" * 200, "c" * 30)
+        # 21 + 51 + 8 tokens: the middle hit does not fit, the last one does
+        assert [h["id"] for h in rag._select_context(hits)] == ["d-0", "d-2"]
+
+
+class TestFormatContext:
+    """Test the canonical <doc> block layout of retrieved context."""
+
+    def test_grouped_and_sorted_by_doc_id(self):
+        top = [
+            {"id": "cv-3", "text": "cv three", "metadata": {"doc_id": "cv"}},
+            {"id": "app-1", "text": "app one", "metadata": {"doc_id": "app"}},
+            {"id": "cv-1", "text": "cv one", "metadata": {"doc_id": "cv"}},
+        ]
+        expected = (
+            '<doc id="app">\napp one\n</doc>\n'
+            '<doc id="cv">\ncv one\n\n---\n\ncv three\n</doc>'
+        )
+        assert rag._format_context(top) == expected
+        assert rag._format_context(top[::-1]) == expected
+
+    def test_doc_id_falls_back_to_chunk_id(self):
+        top = [{"id": 'my "cv"-0', "text": "x", "metadata": None}]
+        assert rag._format_context(top) == "<doc id=\"my 'cv'\">\nx\n</doc>"
+
+
+class TestResponseCache:
+    """Test the semantic /apply response cache."""
+
+    DRAFT = {"cover_letter_markdown": "Hi", "cv_bullets": ["x"], "ats_report": {}}
+
+    @pytest.fixture(autouse=True)
+    def _mocks(self, monkeypatch):
+        rag._embed_query.cache_clear()
+        monkeypatch.setattr(rag, "embed_texts", lambda xs: [[0.1] * 8 for _ in xs])
+        monkeypatch.setattr(rag, "search", lambda q, k=8: [])
+        self.cache = MagicMock()
+        monkeypatch.setattr(rag, "_response_cache", lambda: self.cache)
+        monkeypatch.setattr(rag, "_corpus_count", lambda: 5)
+        self.chat = MagicMock(return_value={"message": {"content": json.dumps(self.DRAFT)}})
+        monkeypatch.setattr(rag._ollama, "chat", self.chat)
+        yield
+        rag._embed_query.cache_clear()
+
+    def test_hit_skips_generation(self):
+        self.cache.query.return_value = {
+            "distances": [[0.01]],
+            "metadatas": [[{"draft": json.dumps(self.DRAFT), "corpus_count": 5}]],
+        }
+        assert rag.generate_application("job") == self.DRAFT
+        self.chat.assert_not_called()
+
+    def test_draft_from_other_corpus_is_ignored(self):
+        # e.g. bulk_ingest added chunks from another process
+        self.cache.query.return_value = {
+            "distances": [[0.01]],
+            "metadatas": [[{"draft": json.dumps({"raw": "old"}), "corpus_count": 3}]],
+        }
+        assert rag.generate_application("job") == self.DRAFT
+        self.chat.assert_called_once()
+        assert self.cache.add.call_args.kwargs["metadatas"][0]["corpus_count"] == 5
+
+    def test_miss_generates_and_stores(self):
+        self.cache.query.return_value = {"distances": [[0.5]], "metadatas": [[{"draft": "{}"}]]}
+        assert rag.generate_application("job") == self.DRAFT
+        self.chat.assert_called_once()
+        stored = self.cache.add.call_args.kwargs["metadatas"][0]["draft"]
+        assert json.loads(stored) == self.DRAFT
+
+    def test_context_in_document_order_before_job_post(self, monkeypatch):
+        self.cache.query.return_value = {"distances": [[]], "metadatas": [[]]}
+        hits = [
+            {"id": "cv-10", "text": "ten", "metadata": {}, "distance": 0.1},
+            {"id": "cv-2", "text": "two", "metadata": {}, "distance": 0.2},
+            {"id": "app-0", "text": "zero", "metadata": {}, "distance": 0.3},
+        ]
+        monkeypatch.setattr(rag, "search", lambda q, k=8: list(hits))
+        rag.generate_application("the job")
+
+        user = self.chat.call_args.kwargs["messages"][1]["content"]
+        assert user.index("zero") < user.index("two") < user.index("ten") < user.index("the job")
+        assert self.chat.call_args.kwargs["options"]["num_ctx"] == rag.GEN_NUM_CTX
+
+    def test_stream_yields_deltas_then_draft(self):
+        self.cache.query.return_value = {"distances": [[]], "metadatas": [[]]}
+        text = json.dumps(self.DRAFT)
+        pieces = [text[:10], text[10:], ""]
+        self.chat.return_value = iter({"message": {"content": p}} for p in pieces)
+
+        events = list(rag.generate_application_stream("job"))
+        assert events[:-1] == [{"delta": text[:10]}, {"delta": text[10:]}]
+        assert events[-1] == {"draft": self.DRAFT}
+        assert self.chat.call_args.kwargs["stream"] is True
+        self.cache.add.assert_called_once()
+
+    def test_stream_cache_hit_yields_only_draft(self):
+        self.cache.query.return_value = {
+            "distances": [[0.01]],
+            "metadatas": [[{"draft": json.dumps(self.DRAFT), "corpus_count": 5}]],
+        }
+        assert list(rag.generate_application_stream("job")) == [{"draft": self.DRAFT}]
+        self.chat.assert_not_called()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])